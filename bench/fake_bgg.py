@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+#Local stand-in for the BGG XML API serving a synthetic collection. Imitates /xmlapi2/user,
+#/xmlapi2/collection (answering 202 while the collection is "queued") and /xmlapi2/thing, plus the
+#box art, with configurable latency and error rates so the client's retry paths get exercised too.
+
+import argparse
+import collections
+import http.server
+import random
+import sys
+import threading
+import time
+from urllib.parse import urlparse, parse_qsl
+
+from synthetic import synthetic_collection
+
+class quiet_server(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        #Clients hanging up on kept-alive connections when they exit is expected.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class fake_bgg:
+    def __init__(self, collection, port=0, latency=0.0, error_rate=0.0, queued=1, thing_limit=0, image_bytes=4096):
+        self.collection  = collection
+        self.latency     = latency
+        self.error_rate  = error_rate
+        self.queued      = queued
+        self.thing_limit = thing_limit
+        self.image_bytes = image_bytes
+        self.random      = random.Random(7)
+        self.lock        = threading.Lock()
+        self.counts      = collections.Counter()
+        self.server      = quiet_server(('127.0.0.1', port), self.handler())
+        self.port        = self.server.server_address[1]
+        self.thread      = None
+        collection.image_base = f'http://127.0.0.1:{self.port}/img'
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.port}/xmlapi2'
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+            return self.counts[key]
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def handler(self):
+        fake = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body=b'', content_type='text/xml; charset=utf-8', headers=()):
+                fake.count(f'status {status}')
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_xml(self, parts):
+                self.send(200, ''.join(parts).encode('utf-8'))
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = dict(parse_qsl(url.query))
+                endpoint = url.path.rsplit('/', 1)[-1] if url.path.startswith('/xmlapi2/') else url.path.split('/')[1]
+                fake.count(f'requests {endpoint}')
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                if endpoint == 'img':
+                    obj_id = int(url.path.rsplit('/', 1)[-1].split('.')[0])
+                    etag = f'"{obj_id}"'
+                    if self.headers.get('If-None-Match') == etag:
+                        return self.send(304, headers=(('ETag', etag),))
+                    return self.send(200, fake.collection.image(obj_id, fake.image_bytes), 'image/jpeg', (('ETag', etag),))
+
+                if endpoint in ('collection', 'thing') and fake.should_fail():
+                    #BGG answers overload with 429 and a short Retry-After, or a bare 500.
+                    if fake.random.random() < 0.5:
+                        return self.send(429, b'<error><message>Rate limit exceeded.</message></error>', headers=(('Retry-After', '1'),))
+                    return self.send(500, b'<error><message>Internal error.</message></error>')
+
+                if endpoint == 'user':
+                    name = params.get('name', '')
+                    return self.send_xml((f'<?xml version="1.0" encoding="utf-8"?><user id="{len(name) * 1000 + 1}" name="{name}"'
+                                          ' termsofuse="https://boardgamegeek.com/xmlapi/termsofuse"><firstname value="Bench"/></user>',))
+
+                if endpoint == 'collection':
+                    if fake.count(f'queued {params.get("username")} {params.get("own")}') <= fake.queued:
+                        return self.send(202, b'<message>Your request for this collection has been accepted and will be processed.  Please try again later for access.</message>')
+                    return self.send_xml(fake.collection.collection_xml(params.get('own') == '1'))
+
+                if endpoint == 'thing':
+                    ids = [int(obj_id) for obj_id in params.get('id', '').split(',') if obj_id.isdigit()]
+                    if fake.thing_limit and len(ids) > fake.thing_limit:
+                        return self.send(400, f'<error><message>Cannot load more than {fake.thing_limit} items</message></error>'.encode())
+                    return self.send_xml(fake.collection.thing_xml(ids))
+
+                self.send(404, b'<error><message>Not found.</message></error>')
+
+        return handler
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Serve a synthetic collection through a fake BGG XML API.')
+    parser.add_argument('-g','--games', dest='games', action='store', default='1000', help='Games in the collection. (Default=1000)')
+    parser.add_argument('--port', dest='port', action='store', default='8000', help='Port to listen on. (Default=8000)')
+    parser.add_argument('--latency', dest='latency', action='store', default='0', help='Seconds added to every response. (Default=0)')
+    parser.add_argument('--error_rate', dest='error_rate', action='store', default='0', help='Fraction of collection and thing requests answered with 429 or 500. (Default=0)')
+    parser.add_argument('--queued', dest='queued', action='store', default='1', help='Times a collection request is answered with 202 before it is served. (Default=1)')
+    parser.add_argument('--thing_limit', dest='thing_limit', action='store', default='0', help='Largest thing batch accepted, 0 for no limit. (Default=0)')
+    parser.add_argument('--seed', dest='seed', action='store', default='1', help='Random seed. (Default=1)')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    fake = fake_bgg(synthetic_collection(int(args.games), int(args.seed)), int(args.port), float(args.latency),
+                    float(args.error_rate), int(args.queued), int(args.thing_limit))
+    print(f'Serving {args.games} games at {fake.url}')
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+#Runs generate_html.py against the fake BGG server at several collection sizes and reports wall
+#time, peak RSS and request counts for a cold cache, a warm cache and a --no_cache run.
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from synthetic import synthetic_collection
+from fake_bgg import fake_bgg
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Everything generate_html.py reads from its working directory.
+repo_files = ['generate_html.py', 'template.html', 'template_card.html', 'style.css', 'style_card.css', 'renderer.js', 'icons']
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark generate_html.py against a local fake BGG server.')
+    parser.add_argument('--scales', dest='scales', action='store', default='100,1000,10000,50000', help='Comma separated collection sizes. (Default=100,1000,10000,50000)')
+    parser.add_argument('--runs', dest='runs', action='store', default='cold,warm,no_cache', help='Comma separated runs, in order, from cold, warm and no_cache. (Default=cold,warm,no_cache)')
+    parser.add_argument('--latency', dest='latency', action='store', default='0', help='Seconds the server adds to every response. (Default=0)')
+    parser.add_argument('--error_rate', dest='error_rate', action='store', default='0', help='Fraction of collection and thing requests that fail. (Default=0)')
+    parser.add_argument('--queued', dest='queued', action='store', default='1', help='202 responses before a collection is served. (Default=1)')
+    parser.add_argument('--thing_limit', dest='thing_limit', action='store', default='0', help='Largest thing batch the server accepts, 0 for no limit. (Default=0)')
+    parser.add_argument('--rate', dest='rate', action='store', default='20', help='--rate passed to generate_html.py. (Default=20)')
+    parser.add_argument('--keep', dest='keep', action='store_true', help='Keep the working directories. (default=Off)')
+    parser.add_argument('--json', dest='json', action='store', default='', help='Also write the results to this JSON file.')
+    parser.add_argument('script_args', nargs='*', help='Extra arguments for generate_html.py, after --, e.g. -- -c -n')
+    return parser.parse_args()
+
+def prepare_workdir():
+    workdir = tempfile.mkdtemp(prefix='bgg_bench_')
+    for name in repo_files:
+        source = os.path.join(repo, name)
+        if os.path.isdir(source):
+            shutil.copytree(source, os.path.join(workdir, name))
+        elif os.path.exists(source):
+            shutil.copy(source, workdir)
+    return workdir
+
+def run_script(workdir, arguments):
+    #wait4 gives the rusage of just this child, so peak RSS is per run.
+    start = time.perf_counter()
+    with open(os.path.join(workdir, 'bench.log'), 'ab') as log:
+        process = subprocess.Popen([sys.executable, 'generate_html.py'] + arguments, cwd=workdir, stdout=log, stderr=log)
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return time.perf_counter() - start, usage.ru_maxrss / 1024, process.returncode
+
+def run_scale(args, games):
+    fake = fake_bgg(synthetic_collection(games), latency=float(args.latency), error_rate=float(args.error_rate),
+                    queued=int(args.queued), thing_limit=int(args.thing_limit)).start()
+    workdir = prepare_workdir()
+    base_arguments = ['-u', 'bench', '--bgg_url', fake.url, '--rate', args.rate, '--minsleep', '1', '--maxsleep', '8'] + args.script_args
+    results = []
+    try:
+        for run in args.runs.split(','):
+            fake.reset()
+            arguments = base_arguments + (['--no_cache'] if run == 'no_cache' else [])
+            wall, rss, code = run_script(workdir, arguments)
+            counts = fake.snapshot()
+            results.append({
+                'games':    games,
+                'run':      run,
+                'wall':     round(wall, 3),
+                'peak_rss': round(rss, 1),
+                'exit':     code,
+                'requests': {key[9:]: value for key, value in sorted(counts.items()) if key.startswith('requests ')},
+                'statuses': {key[7:]: value for key, value in sorted(counts.items()) if key.startswith('status ')},
+            })
+            print_result(results[-1])
+    finally:
+        fake.stop()
+        if args.keep:
+            print(f'  working directory: {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def print_result(result):
+    requests = ' '.join(f'{key}={value}' for key, value in result['requests'].items()) or 'none'
+    statuses = ' '.join(f'{key}={value}' for key, value in result['statuses'].items()) or 'none'
+    failed = '' if result['exit'] == 0 else f'  FAILED exit={result["exit"]}'
+    print(f'{result["games"]:>7} {result["run"]:<9} {result["wall"]:>9.2f}s {result["peak_rss"]:>9.1f}MB  requests: {requests}  statuses: {statuses}{failed}', flush=True)
+
+def main():
+    args = parse_arguments()
+    print(f'{"games":>7} {"run":<9} {"wall":>10} {"peak rss":>11}')
+    results = []
+    for games in args.scales.split(','):
+        results += run_scale(args, int(games))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=1)
+    if any(result['exit'] != 0 for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
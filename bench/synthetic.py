@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+#Synthetic BGG collection and thing XML for benchmarks. Everything is derived from a seed and the
+#object id, so a 50k game collection costs a few MB of memory and the same id always gives the same
+#game no matter which batch asks for it.
+
+import argparse
+import os
+import random
+import struct
+from xml.sax.saxutils import escape, quoteattr
+
+######### Begin Globals #########
+
+articles = ["The", "A", "Le"]
+
+words = ["Castle", "Harbor", "Empire", "Dragon", "Garden", "Railway", "Kingdom", "Voyage", "Forest", "Colony",
+         "Market", "Temple", "Island", "Galaxy", "Station", "Dungeon", "Village", "Ocean", "Mountain", "Desert",
+         "Guild", "Crown", "Shadow", "River", "Tower", "Frontier", "Citadel", "Orchard", "Legacy", "Expedition"]
+
+lorem = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et "
+         "dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip "
+         "ex ea commodo consequat &amp; duis aute irure dolor in reprehenderit in voluptate velit esse.&#10;&#10;").split(" ")
+
+#Pool sizes and per game link counts roughly follow BGG: a few categories, a handful of mechanics,
+#one or two designers and a long tail of publishers for popular games.
+link_types = {
+    'boardgamecategory':  (84,   1, 5),
+    'boardgamemechanic':  (190,  1, 9),
+    'boardgamefamily':    (3000, 0, 8),
+    'boardgamedesigner':  (5000, 1, 3),
+    'boardgameartist':    (4000, 0, 5),
+    'boardgamepublisher': (2500, 1, 15),
+}
+
+######### End Globals #########
+
+class synthetic_collection:
+    def __init__(self, games, seed=1, first_id=100000, image_base='http://127.0.0.1:8000/img'):
+        self.seed       = seed
+        self.image_base = image_base.rstrip('/')
+        self.ids        = [first_id + i for i in range(games)]
+        self.id_set     = set(self.ids)
+
+    def rng(self, obj_id):
+        return random.Random(self.seed * 1000003 + obj_id)
+
+    def game(self, obj_id):
+        rng = self.rng(obj_id)
+        name = " ".join(rng.choice(words) for _ in range(rng.randint(1, 3))) + " " + str(obj_id)
+        roll = rng.random()
+        if roll < 0.15:
+            name = rng.choice(articles) + " " + name
+        elif roll < 0.2:
+            name = str(rng.randint(1, 9)) + " " + name
+        minplayers = rng.choice((1, 1, 2, 2, 2, 3))
+        minplaytime = rng.choice((15, 20, 30, 45, 60, 90, 120))
+        return {
+            'obj_id':      obj_id,
+            'name':        name,
+            'year':        rng.randint(1960, 2025),
+            'minplayers':  minplayers,
+            'maxplayers':  minplayers + rng.choice((0, 1, 2, 2, 3, 4, 6)),
+            'minplaytime': minplaytime,
+            'maxplaytime': minplaytime * rng.choice((1, 1, 2, 3)),
+            'weight':      round(rng.uniform(1.0, 4.8), 4),
+            'average':     round(rng.uniform(5.0, 8.9), 5),
+            'rating':      rng.choice(("N/A", "N/A", str(rng.randint(4, 10)))),
+            'own':         int(rng.random() < 0.8),
+            'rng':         rng,
+        }
+
+    def image_url(self, obj_id):
+        return f'{self.image_base}/{obj_id}.jpg'
+
+    def collection_item(self, obj_id):
+        game = self.game(obj_id)
+        return (f'<item objecttype="thing" objectid="{obj_id}" subtype="boardgame" collid="{obj_id * 7}">'
+                f'<name sortindex="1">{escape(game["name"])}</name><yearpublished>{game["year"]}</yearpublished>'
+                f'<image>{self.image_url(obj_id)}</image><thumbnail>{self.image_url(obj_id)}</thumbnail>'
+                f'<stats minplayers="{game["minplayers"]}" maxplayers="{game["maxplayers"]}" minplaytime="{game["minplaytime"]}"'
+                f' maxplaytime="{game["maxplaytime"]}" playingtime="{game["maxplaytime"]}" numowned="{obj_id % 9000}">'
+                f'<rating value="{game["rating"]}"><usersrated value="{obj_id % 5000}"/><average value="{game["average"]}"/>'
+                f'<bayesaverage value="{game["average"] - 0.5:.5f}"/><stddev value="1.4"/><median value="0"/></rating></stats>'
+                f'<status own="{game["own"]}" prevowned="0" fortrade="0" want="0" wanttoplay="0" wanttobuy="0" wishlist="0"'
+                f' preordered="0" lastmodified="2024-01-01 12:00:00"/><numplays>{obj_id % 4}</numplays></item>')
+
+    def collection_xml(self, own=False):
+        ids = [obj_id for obj_id in self.ids if not own or self.game(obj_id)['own']]
+        yield f'<?xml version="1.0" encoding="utf-8" standalone="yes"?>\n<items totalitems="{len(ids)}" termsofuse="https://boardgamegeek.com/xmlapi/termsofuse">'
+        for obj_id in ids:
+            yield self.collection_item(obj_id)
+        yield '</items>'
+
+    def thing_item(self, obj_id):
+        game = self.game(obj_id)
+        rng = game['rng']
+        #Descriptions are a few hundred to several thousand characters, skewed short like on BGG.
+        length = min(6000, int(rng.lognormvariate(6.9, 0.6)))
+        description = []
+        size = 0
+        while size < length:
+            word = rng.choice(lorem)
+            description.append(word)
+            size += len(word) + 1
+        links = []
+        for link_type, (pool, low, high) in link_types.items():
+            for link_id in rng.sample(range(1, pool + 1), rng.randint(low, high)):
+                value = quoteattr(f'{link_type[9:].capitalize()} {link_id}')
+                links.append(f'<link type="{link_type}" id="{link_id}" value={value}/>')
+        return (f'<item type="boardgame" id="{obj_id}"><thumbnail>{self.image_url(obj_id)}</thumbnail><image>{self.image_url(obj_id)}</image>'
+                f'<name type="primary" sortindex="1" value={quoteattr(game["name"])}/>'
+                f'<name type="alternate" sortindex="1" value={quoteattr(game["name"][::-1])}/>'
+                f'<description>{" ".join(description)}</description><yearpublished value="{game["year"]}"/>'
+                f'<minplayers value="{game["minplayers"]}"/><maxplayers value="{game["maxplayers"]}"/>'
+                f'<playingtime value="{game["maxplaytime"]}"/><minplaytime value="{game["minplaytime"]}"/>'
+                f'<maxplaytime value="{game["maxplaytime"]}"/><minage value="10"/>{"".join(links)}'
+                f'<statistics page="1"><ratings><usersrated value="{obj_id % 5000}"/><average value="{game["average"]}"/>'
+                f'<bayesaverage value="{game["average"] - 0.5:.5f}"/><stddev value="1.4"/><median value="0"/>'
+                f'<owned value="{obj_id % 9000}"/><numweights value="{obj_id % 300}"/>'
+                f'<averageweight value="{game["weight"]}"/></ratings></statistics></item>')
+
+    def thing_xml(self, ids):
+        yield '<?xml version="1.0" encoding="utf-8"?><items termsofuse="https://boardgamegeek.com/xmlapi/termsofuse">'
+        for obj_id in ids:
+            if obj_id in self.id_set:
+                yield self.thing_item(obj_id)
+        yield '</items>'
+
+    def image(self, obj_id, size=4096):
+        #A JPEG header with a start-of-frame marker, so image sizes can be read, padded to size bytes.
+        rng = self.rng(obj_id)
+        width, height = rng.choice(((600, 600), (800, 600), (600, 800), (1024, 768)))
+        head = b'\xff\xd8' + b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, height, width, 3) + b'\x01\x22\x00'
+        body = (str(obj_id).encode() + b'.') * (size // 6 + 1)
+        return head + body[:max(0, size - len(head) - 2)] + b'\xff\xd9'
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Write a synthetic BGG collection and thing XML to disk.')
+    parser.add_argument('-g','--games', dest='games', action='store', default='1000', help='Games in the collection. (Default=1000)')
+    parser.add_argument('--seed', dest='seed', action='store', default='1', help='Random seed. (Default=1)')
+    parser.add_argument('--out', dest='out', action='store', default='./synthetic', help='Output directory. (Default="./synthetic")')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    collection = synthetic_collection(int(args.games), int(args.seed))
+    os.makedirs(args.out, exist_ok=True)
+    with open(os.path.join(args.out, 'collection.xml'), 'w', encoding='utf-8') as file:
+        file.writelines(collection.collection_xml())
+    with open(os.path.join(args.out, 'things.xml'), 'w', encoding='utf-8') as file:
+        file.writelines(collection.thing_xml(collection.ids))
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,41 @@
 
 import requests
 import textwrap
-import shutil
 import argparse
 import os
 import sys
-from time import sleep
+import time
+import asyncio
+from email.utils import parsedate_to_datetime
 from xml.etree import ElementTree
 import logging
-from urllib.parse import urlencode, quote
+from urllib.parse import urlencode, quote, urlparse
 from datetime import datetime
 import contextlib
-import pprint
+import copy
+import struct
+import re
+import json
+import hashlib
+import base64
+import io
+import sqlite3
+import threading
+import tempfile
+import collections
+import mimetypes
+import http.server
+from urllib.parse import parse_qs, unquote
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from requests.adapters import HTTPAdapter
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 starttime = datetime.now()
 ######### Begin Classes #########
@@ -20,11 +44,8 @@ starttime = datetime.now()
 class config:
     def __init__(self, args):
         self.LOGLEVEL                = os.environ.get('LOGLEVEL', 'INFO').upper()
-        self.bgg                     = 'https://boardgamegeek.com/xmlapi2'
-        self.successful_responses    = 0
-        self.dict_player_count       = {}
-        self.dict_category           = {}
-        self.dict_game_info           = {}
+        self.bgg                     = args.bgg_url.rstrip('/') if len(args.bgg_url) > 0 else 'https://boardgamegeek.com/xmlapi2'
+        self.index_data              = index_builder()
 
         self.user_name               = args.username
         self.card_mode               = args.cardmode or False
@@ -38,54 +59,1288 @@ class config:
         self.collection_xml          = args.collection_xml if len(args.collection_xml) > 0 else"./collection.xml"
         self.images_path             = args.images_path if len(args.images_path) > 0 else"./Images"
         self.xml_path                = args.xml_path if len(args.xml_path) > 0 else"./game_xml"
+        self.metadata_db             = args.metadata_db if len(args.metadata_db) > 0 else"./game_xml.sqlite"
 
         self.sleep_time              = int(args.minsleep) if len(args.minsleep) > 0 else 10
         self.sleep_time_max          = int(args.maxsleep) if len(args.maxsleep) > 0 else 120
+        self.retries                 = int(args.retries) if len(args.retries) > 0 else 10
+        self.request_rate            = float(args.rate) if len(args.rate) > 0 else 2.0
+        self.concurrency             = int(args.concurrency) if len(args.concurrency) > 0 else 3
+        self.queue_retry             = 5
+        self.client                  = None
+        self.store                   = None
         self.no_cache                = args.no_cache or False
+        self.image_threads           = int(args.image_threads) if len(args.image_threads) > 0 else 8
+        self.image_budget            = int(float(args.image_budget) * 1024 * 1024) if len(args.image_budget) > 0 else 1024 * 1024 * 1024
+        self.image_cache             = None
         self.web_mode                = os.path.exists("./app.py")
 
         self.generate_navigation     = args.navigation or False
+        self.incremental             = args.incremental or False
+        self.paged                   = args.paged or False
+        self.json_mode               = args.json or False
+        self.renderer                = "./renderer.js"
+        self.jobs                    = int(args.jobs) if len(args.jobs) > 0 else 1
+        self.ttl                     = float(args.ttl) * 24 * 60 * 60 if len(args.ttl) > 0 else 30 * 24 * 60 * 60
+        self.max_refresh             = int(args.max_refresh) if len(args.max_refresh) > 0 else 50
+        self.refresh_batch           = 20
+        self.thing_batch             = 100
+        self.compiled_template       = None
+        self.metrics                 = run_metrics()
+        self.metrics_path            = args.metrics
+        self.record_path             = args.record
+        self.replay_path             = args.replay
+        self.replay_latency          = float(args.replay_latency) if len(args.replay_latency) > 0 else 0.0
+        self.cassette                = None
+        self.serve_port              = int(args.serve) if len(args.serve) > 0 else 0
+        self.resume                  = args.resume or False
+        self.journal_path            = os.path.splitext(self.metadata_db)[0] + ".run.json"
+        self.journal                 = None
+        self.checkpoint_every        = 200
+        self.serve_refresh           = float(args.serve_refresh) * 60 if len(args.serve_refresh) > 0 else 60 * 60
+        self.watch                   = args.watch or False
+        self.watch_interval          = 0.2
+
+class run_metrics:
+    #Wall time per stage plus counters, written as JSON by --metrics. The client, the image pool
+    #and the background refresh all count from their own threads, so everything goes through the lock.
+    def __init__(self):
+        self.lock     = threading.Lock()
+        self.started  = time.time()
+        self.stages   = {}
+        self.counters = {}
+        self.statuses = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def status(self, status_code):
+        with self.lock:
+            self.statuses[str(status_code)] = self.statuses.get(str(status_code), 0) + 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+                stage['seconds'] += elapsed
+                stage['calls']   += 1
+
+    def report(self):
+        with self.lock:
+            return {
+                'started':      datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'total_seconds': round(time.time() - self.started, 3),
+                'command':      sys.argv,
+                'stages':       {name: {'seconds': round(stage['seconds'], 3), 'calls': stage['calls']} for name, stage in self.stages.items()},
+                'counters':     {name: round(value, 3) if isinstance(value, float) else value for name, value in sorted(self.counters.items())},
+                'status_codes': dict(sorted(self.statuses.items())),
+            }
+
+    def write(self, path):
+        with output_sink(path) as sink:
+            sink.write(json.dumps(self.report(), indent=1))
 
 class collection_information:
+    __slots__ = ('obj_id', 'game_name', 'own', 'status', 'my_rating', 'avg_rating', 'my_image')
+
     def __init__(self, item, config):
         self.obj_id     = item.attrib['objectid']
         self.game_name  = item.find('name').text
-        self.game_xml   = os.path.join(config.xml_path, self.obj_id + '.xml')
         self.own        = item.find('status').attrib['own'] == "1"
-        self.my_rating  = "N/A" 
-        self.avg_rating = 0.0 
-        stats_item = item.find('stats')
-        if stats_item is not None:
-            self.my_rating  = item.find('stats').find('rating').attrib['value']
-            self.avg_rating = item.find('stats').find('rating').find('average').attrib['value']
-        self.my_image   = item.find('image').text if item.find('image') != None else ""
+        self.status     = tuple(sorted(item.find('status').attrib.items()))
+        self.my_rating  = None #None when the user has not rated the game ("N/A" on BGG).
+        self.avg_rating = 0.0
+        rating_item = item.find('stats/rating')
+        if rating_item is not None:
+            self.my_rating  = parse_float(rating_item.attrib['value'])
+            self.avg_rating = parse_float(rating_item.find('average').attrib['value']) or 0.0
+        image_item = item.find('image')
+        self.my_image   = image_item.text if image_item is not None else ""
 
 class game_information:
-    def __init__(self, items, config, collection_info):
-        self.image                  = collection_info.my_image if collection_info.my_image != "" else get_prop_text(items, 'image')
-        self.name                   = get_prop_value(items, 'name')
+    __slots__ = ('image', 'name', 'obj_id', 'my_rating', 'avg_rating', 'minplayers', 'maxplayers', 'published',
+                 'publisher', 'designer', 'designers', 'artist1', 'artist2', 'category1', 'category2', 'categories',
+                 'mechanic1', 'mechanic2', 'mechanic3', 'mechanic4', 'mechanics', 'mintime', 'maxtime',
+                 'avg_weight', 'three_mechanics_length', 'four_mechanics_length', 'description', 'local_image', 'image_size')
+
+    def __init__(self, fields, config, collection_info):
+        links = fields['links']
+        self.image                  = collection_info.my_image if collection_info.my_image != "" else fields['image']
+        self.name                   = fields['name']
         self.obj_id                 = collection_info.obj_id
         self.my_rating              = collection_info.my_rating
         self.avg_rating             = collection_info.avg_rating
-        self.minplayers             = str(get_prop_value(items, 'minplayers') or '')
-        self.maxplayers             = str(get_prop_value(items, 'maxplayers') or '')
-        self.published              = get_prop_value(items, 'yearpublished')
-        self.publisher              = get_value_in_list(get_links(items, 'boardgamepublisher'), 0)
-        self.designer               = get_value_in_list(get_links(items, 'boardgamedesigner'), 0)
-        self.artist1                = get_value_in_list(get_links(items, 'boardgameartist'), 0)
-        self.artist2                = get_value_in_list(get_links(items, 'boardgameartist'), 1)
-        self.category1              = get_value_in_list(get_links(items, 'boardgamecategory'), 0)
-        self.category2              = get_value_in_list(get_links(items, 'boardgamecategory'), 1)
-        self.mechanic1              = get_value_in_list(get_links(items, 'boardgamemechanic'), 0)
-        self.mechanic2              = get_value_in_list(get_links(items, 'boardgamemechanic'), 1)
-        self.mechanic3              = get_value_in_list(get_links(items, 'boardgamemechanic'), 2)
-        self.mechanic4              = get_value_in_list(get_links(items, 'boardgamemechanic'), 3)
-        self.mintime                = str(get_prop_value(items, 'minplaytime') or '')
-        self.maxtime                = str(get_prop_value(items, 'maxplaytime') or '')
-        self.avg_weight             = items.find('statistics').find('ratings').find('averageweight').attrib['value']
+        self.minplayers             = parse_int(fields['minplayers'])
+        self.maxplayers             = parse_int(fields['maxplayers'])
+        self.published              = fields['yearpublished']
+        self.publisher              = get_value_in_list(links.get('boardgamepublisher', []), 0)
+        self.designers              = links.get('boardgamedesigner', [])
+        self.designer               = get_value_in_list(self.designers, 0)
+        self.artist1                = get_value_in_list(links.get('boardgameartist', []), 0)
+        self.artist2                = get_value_in_list(links.get('boardgameartist', []), 1)
+        self.categories             = links.get('boardgamecategory', [])
+        self.category1              = get_value_in_list(self.categories, 0)
+        self.category2              = get_value_in_list(self.categories, 1)
+        self.mechanics              = links.get('boardgamemechanic', [])
+        self.mechanic1              = get_value_in_list(self.mechanics, 0)
+        self.mechanic2              = get_value_in_list(self.mechanics, 1)
+        self.mechanic3              = get_value_in_list(self.mechanics, 2)
+        self.mechanic4              = get_value_in_list(self.mechanics, 3)
+        self.mintime                = parse_int(fields['minplaytime'])
+        self.maxtime                = parse_int(fields['maxplaytime'])
+        self.avg_weight             = parse_float(fields['weight']) or 0.0
         self.three_mechanics_length = len((self.mechanic1 or "") + (self.mechanic2 or "") + (self.mechanic3 or ""))
         self.four_mechanics_length  = len((self.mechanic1 or "") + (self.mechanic2 or "") + (self.mechanic3 or "") + (self.mechanic4 or ""))
-        self.description            = textwrap.shorten(get_prop_text(items, 'description') or "", width=get_description_length(config), placeholder='...')
+        self.description            = textwrap.shorten(fields['description'] or "", width=get_description_length(config), placeholder='...')
+        self.local_image            = None #Path and (width, height) of the cached box art, filled in by whoever knows the image cache.
+        self.image_size             = None
+
+class index_entry:
+    #The little the index needs from a game, so building it doesn't keep whole games alive.
+    __slots__ = ('name', 'minplayers', 'maxplayers', 'categories', 'mechanics', 'designers', 'avg_weight', 'mintime', 'maxtime')
+
+    def __init__(self, gameinfo):
+        self.name       = gameinfo.name
+        self.minplayers = gameinfo.minplayers
+        self.maxplayers = gameinfo.maxplayers
+        self.categories = tuple(gameinfo.categories)
+        self.mechanics  = tuple(gameinfo.mechanics)
+        self.designers  = tuple(gameinfo.designers)
+        self.avg_weight = gameinfo.avg_weight
+        self.mintime    = gameinfo.mintime
+        self.maxtime    = gameinfo.maxtime
+
+class index_builder:
+    #Inverted indexes for the printed index: facet -> key -> games, in normalized name order.
+    facets         = ('players', 'category', 'mechanic', 'designer', 'weight', 'playtime')
+    playtime_steps = (30, 60, 90, 120, 180)
+
+    def __init__(self):
+        self.games   = []
+        self.entries = None
+
+    def add(self, gameinfo):
+        self.games.append(index_entry(gameinfo))
+        self.entries = None
+
+    def build(self):
+        #Sort once, then a single pass over the games fills every facet already in name order.
+        entries = {facet: {} for facet in self.facets}
+        for game in sorted(self.games, key=lambda game: parse_name_start(game.name or "").casefold()):
+            for facet in self.facets:
+                for key in getattr(self, facet + '_keys')(game):
+                    entries[facet].setdefault(key, []).append(game)
+        self.entries = entries
+        return entries
+
+    def players_keys(self, game):
+        if (game.minplayers is None or game.maxplayers is None):
+            return ()
+        return range(game.minplayers, max(game.minplayers, game.maxplayers) + 1)
+
+    def category_keys(self, game):
+        return game.categories
+
+    def mechanic_keys(self, game):
+        return game.mechanics
+
+    def designer_keys(self, game):
+        return game.designers
+
+    def weight_keys(self, game):
+        #Unrated games have a weight of 0, the BGG scale runs 1 to 5.
+        if (game.avg_weight < 1):
+            return ()
+        return (min(int(game.avg_weight), 4),)
+
+    def playtime_keys(self, game):
+        playtime = game.maxtime or game.mintime
+        if not playtime:
+            return ()
+        return (sum(1 for step in self.playtime_steps if playtime > step),)
+
+    def title(self, facet, key):
+        if (facet == 'players'):
+            return str(key) + " player games:"
+        if (facet == 'designer'):
+            return "Designed by " + key + ":"
+        if (facet == 'weight'):
+            return "Weight " + str(key) + " - " + str(key + 1) + " games:"
+        if (facet == 'playtime'):
+            steps = self.playtime_steps
+            if (key == 0):
+                return "Up to " + str(steps[0]) + " minute games:"
+            if (key == len(steps)):
+                return "Over " + str(steps[-1]) + " minute games:"
+            return str(steps[key - 1]) + " - " + str(steps[key]) + " minute games:"
+        return key + " games:"
+
+    def sections(self, facet):
+        entries = (self.entries or self.build())[facet]
+        if (facet in ('category', 'mechanic', 'designer')):
+            keys = sorted(entries, key=str.casefold)
+        else:
+            keys = sorted(entries)
+        for key in keys:
+            yield self.title(facet, key), entries[key]
+
+class metadata_store:
+    #Single file cache of BGG thing data: the raw <item> XML plus the fields game_information needs,
+    #so a warm run never has to parse XML at all.
+    columns = ('obj_id', 'type', 'name', 'image', 'yearpublished', 'minplayers', 'maxplayers',
+               'minplaytime', 'maxplaytime', 'weight', 'links', 'description', 'xml')
+
+    def __init__(self, path):
+        self.path       = path
+        #--serve builds on whichever request thread gets there first, one build at a time.
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        #WAL lets the background refresh write while the main thread reads.
+        if path != ':memory:':
+            self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS things (
+                obj_id        TEXT PRIMARY KEY,
+                type          TEXT,
+                name          TEXT,
+                image         TEXT,
+                yearpublished TEXT,
+                minplayers    TEXT,
+                maxplayers    TEXT,
+                minplaytime   TEXT,
+                maxplaytime   TEXT,
+                weight        TEXT,
+                links         TEXT,
+                description   TEXT,
+                xml           TEXT NOT NULL,
+                fetched_at    REAL)''')
+            #Databases created before fetch times were recorded.
+            if 'fetched_at' not in [row['name'] for row in self.connection.execute('PRAGMA table_info(things)')]:
+                self.connection.execute('ALTER TABLE things ADD COLUMN fetched_at REAL')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS things_fetched_at ON things (fetched_at)')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS fragments (
+                obj_id        TEXT NOT NULL,
+                variant       TEXT NOT NULL,
+                key           TEXT NOT NULL,
+                html          TEXT NOT NULL,
+                PRIMARY KEY (obj_id, variant))''')
+            #Ids BGG had no thing for, so they aren't asked for again on every run.
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS missing (
+                obj_id        TEXT PRIMARY KEY,
+                checked_at    REAL NOT NULL)''')
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS settings (
+                key           TEXT PRIMARY KEY,
+                value         TEXT NOT NULL)''')
+
+    def put_items(self, content, fetched_at=None):
+        #content is a thing response body, <items> or a lone <item>.
+        fetched_at = fetched_at or time.time()
+        rows = []
+        for fields in thing_records(content):
+            fields['links'] = json.dumps(fields['links'])
+            rows.append(tuple(fields[column] for column in self.columns) + (fetched_at,))
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO things (' + ', '.join(self.columns) + ', fetched_at) VALUES (' + ', '.join('?' * (len(self.columns) + 1)) + ')',
+                rows)
+            self.connection.executemany('DELETE FROM missing WHERE obj_id = ?', [(row[0],) for row in rows])
+        #The ids stored.
+        return [row[0] for row in rows]
+
+    def get(self, obj_id):
+        #The raw XML is only kept for reference, leave it on disk.
+        query = 'SELECT ' + ', '.join(self.columns[:-1]) + ' FROM things WHERE obj_id = ?'
+        row = self.connection.execute(query, (obj_id,)).fetchone()
+        if row is None:
+            return None
+        fields = dict(row)
+        fields['links'] = json.loads(fields['links'])
+        return fields
+
+    def missing_ids(self, obj_ids, missing_cutoff=None):
+        #Ids we have no data for. Ids BGG had nothing for after missing_cutoff are left out too.
+        present = set()
+        obj_ids = list(obj_ids)
+        #Stay well under SQLite's limit on bound parameters.
+        for start in range(0, len(obj_ids), 500):
+            chunk = obj_ids[start:start + 500]
+            query = 'SELECT obj_id FROM things WHERE obj_id IN (' + ', '.join('?' * len(chunk)) + ')'
+            present.update(row[0] for row in self.connection.execute(query, chunk))
+            if missing_cutoff is not None:
+                query = 'SELECT obj_id FROM missing WHERE checked_at >= ? AND obj_id IN (' + ', '.join('?' * len(chunk)) + ')'
+                present.update(row[0] for row in self.connection.execute(query, [missing_cutoff] + chunk))
+        return [obj_id for obj_id in obj_ids if obj_id not in present]
+
+    def put_missing(self, obj_ids):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO missing (obj_id, checked_at) VALUES (?, ?)', [(obj_id, time.time()) for obj_id in obj_ids])
+
+    def is_missing(self, obj_id, cutoff):
+        return self.connection.execute('SELECT 1 FROM missing WHERE obj_id = ? AND checked_at >= ?', (obj_id, cutoff)).fetchone() is not None
+
+    def get_setting(self, key):
+        row = self.connection.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row['value']
+
+    def put_setting(self, key, value):
+        with self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def stale_ids(self, obj_ids, cutoff, limit):
+        #The oldest entries fetched before cutoff, at most limit of them.
+        stale = []
+        obj_ids = list(obj_ids)
+        for start in range(0, len(obj_ids), 500):
+            chunk = obj_ids[start:start + 500]
+            query = 'SELECT obj_id, fetched_at FROM things WHERE (fetched_at IS NULL OR fetched_at < ?) AND obj_id IN (' + ', '.join('?' * len(chunk)) + ')'
+            stale.extend(self.connection.execute(query, [cutoff] + chunk).fetchall())
+        stale.sort(key=lambda row: row['fetched_at'] or 0)
+        return [row['obj_id'] for row in stale[:limit]]
+
+    def get_fragment(self, obj_id, variant, key):
+        row = self.connection.execute('SELECT key, html FROM fragments WHERE obj_id = ? AND variant = ?', (obj_id, variant)).fetchone()
+        if row is None or row['key'] != key:
+            return None
+        return row['html']
+
+    def put_fragments(self, fragments):
+        #fragments is a list of (obj_id, variant, key, html).
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO fragments (obj_id, variant, key, html) VALUES (?, ?, ?, ?)', fragments)
+
+    def delete_things(self, obj_ids):
+        with self.connection:
+            self.connection.executemany('DELETE FROM things WHERE obj_id = ?', [(obj_id,) for obj_id in obj_ids])
+
+    def delete_fragments(self, obj_ids):
+        with self.connection:
+            self.connection.executemany('DELETE FROM fragments WHERE obj_id = ?', [(obj_id,) for obj_id in obj_ids])
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM things')
+            self.connection.execute('DELETE FROM fragments')
+            self.connection.execute('DELETE FROM missing')
+        self.connection.execute('VACUUM')
+
+    def migrate_directory(self, xml_path):
+        #One-shot import of the old one-file-per-game cache. Imported files are removed.
+        if not (os.path.isdir(xml_path)):
+            return
+        names = [f for f in os.listdir(xml_path) if f.endswith('.xml')]
+        if not names:
+            return
+        logging.warning(f'Migrating {len(names)} game XML files from {xml_path} to {self.path}')
+        for f in names:
+            path = os.path.join(xml_path, f)
+            try:
+                with open(path, 'r', encoding="utf-8") as file:
+                    self.put_items(file.read().encode('utf-8'), fetched_at=os.path.getmtime(path))
+            except xml_errors + (KeyError, AttributeError):
+                logging.warning(f'Skipping unreadable game XML {path}')
+            os.remove(path)
+        with contextlib.suppress(OSError):
+            os.rmdir(xml_path)
+
+    def close(self):
+        self.connection.close()
+
+def open_store(config):
+    #--no_cache keeps the same store in memory for the length of the run.
+    if(config.store is None):
+        config.store = metadata_store(':memory:' if config.no_cache else config.metadata_db)
+    return config.store
+
+class compiled_template:
+    #Every placeholder template_to_output_entry knows how to fill.
+    known_placeholders = (
+        'anchor', 'image', 'image_attributes', 'BGGLink', 'GameName', 'Description', 'Published', 'Publisher',
+        'Designer', 'Artist', 'Category', 'Mec', 'p', 'd', 'Weight', 'Rating',
+    )
+    placeholder_pattern = re.compile(r'\{\{(\w+)\}\}')
+
+    def __init__(self, text, path):
+        self.path     = path
+        self.source   = text
+        self.digest   = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        self.segments = []
+        self.fields   = []
+
+        #Split the template into literal text and placeholder slots once, so rendering is a single join.
+        position = 0
+        for match in self.placeholder_pattern.finditer(text):
+            name = match.group(1)
+            self.segments.append(text[position:match.start()])
+            if name in self.known_placeholders:
+                self.fields.append((len(self.segments), name))
+                self.segments.append('')
+            else:
+                #Unknown placeholders are left in the output untouched.
+                self.segments.append(match.group(0))
+            position = match.end()
+        self.segments.append(text[position:])
+
+        used    = [name for index, name in self.fields]
+        unknown = sorted(set(self.placeholder_pattern.findall(text)) - set(self.known_placeholders))
+        missing = [name for name in self.known_placeholders if name not in used]
+        if unknown:
+            logging.warning(f'Template {path} has unknown placeholders: {", ".join(unknown)}')
+        if missing:
+            logging.info(f'Template {path} does not use placeholders: {", ".join(missing)}')
+
+    def render(self, values):
+        parts = self.segments.copy()
+        for index, name in self.fields:
+            parts[index] = values[name]
+        return ''.join(parts)
+
+class output_sink:
+    #Streams the whole output document through one buffered handle into a temp file next to the
+    #destination, and only renames it into place once the document is complete.
+    def __init__(self, path, buffer_size=1024 * 1024, metrics=None):
+        self.path      = path
+        self.metrics   = metrics
+        directory      = os.path.dirname(os.path.abspath(path))
+        fd, self.temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+        self.file      = os.fdopen(fd, 'w', encoding="utf-8", buffering=buffer_size)
+
+    def write(self, text):
+        self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+    def commit(self):
+        if self.file is None:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        #mkstemp creates the file private to us, give it the usual permissions for a new file.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.temp_path, 0o666 & ~umask)
+        if self.metrics is not None:
+            self.metrics.count('bytes_written', os.path.getsize(self.temp_path))
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+class token_bucket:
+    def __init__(self, rate, capacity):
+        self.rate     = rate
+        self.capacity = capacity
+        self.tokens   = capacity
+        self.updated  = time.monotonic()
+
+    #Take a token if one is available. Returns 0 on success, otherwise the seconds until one will be.
+    def take(self):
+        now          = time.monotonic()
+        self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class bgg_error(Exception):
+    #BGG refused the request itself (4xx other than throttling), sending it again won't help.
+    def __init__(self, status, message):
+        super().__init__(f'HTTP Status {status}: {message}')
+        self.status  = status
+        self.message = message
+
+class bgg_client:
+    #Keeps up to config.concurrency requests in flight, paced by a token bucket whose rate is
+    #adjusted AIMD style: every success adds a little, every throttle response halves it.
+    #The rate and any Retry-After pause are shared by everyone using the client.
+    def __init__(self, config):
+        self.config    = config
+        self.max_rate  = config.request_rate
+        self.min_rate  = 1.0 / config.sleep_time_max
+        self.bucket    = token_bucket(config.request_rate, max(1, config.concurrency))
+        self.resume_at = 0.0
+        self.loop      = None
+        self.session   = requests.Session()
+        adapter = http_adapter(config, pool_connections=1, pool_maxsize=max(1, config.concurrency))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def bind_loop(self):
+        #asyncio primitives belong to one event loop, make new ones if we are called from another.
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop      = loop
+            self.lock      = asyncio.Lock()
+            self.in_flight = asyncio.Semaphore(max(1, self.config.concurrency))
+
+    async def acquire(self):
+        metrics = self.config.metrics
+        async with self.lock:
+            while True:
+                pause = self.resume_at - time.monotonic()
+                if pause > 0:
+                    metrics.count('backoff_seconds', pause)
+                    await asyncio.sleep(pause)
+                    continue
+                wait = self.bucket.take()
+                if wait == 0:
+                    return
+                metrics.count('rate_limit_seconds', wait)
+                await asyncio.sleep(wait)
+
+    def on_success(self):
+        self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate / 10)
+
+    def on_throttle(self, pause):
+        self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+        self.resume_at   = max(self.resume_at, time.monotonic() + pause)
+
+    def url(self, command, params):
+        return '{}/{}?{}'.format(self.config.bgg, quote(command), urlencode(params))
+
+    def failure_pause(self, failures):
+        #Double the pause with every failure in a row, from --minsleep up to --maxsleep.
+        return min(self.config.sleep_time * 2 ** (failures - 1), self.config.sleep_time_max)
+
+    #Same command/params shape as bgg_getter, for use from coroutines.
+    #Gives up after config.retries failures in a row, by raising the last error.
+    async def get(self, command, params, stream=False):
+        self.bind_loop()
+        metrics = self.config.metrics
+        url = self.url(command, params)
+        attempt  = 0
+        failures = 0
+        while True:
+            if attempt > 0:
+                metrics.count('http_retries')
+            attempt += 1
+            async with self.in_flight:
+                await self.acquire()
+                logging.debug(url)
+                metrics.count('http_requests')
+                metrics.count('http_requests_' + command)
+                try:
+                    response = await asyncio.to_thread(self.session.get, url, timeout=60, stream=stream)
+                except requests.RequestException as e:
+                    metrics.count('http_errors')
+                    failures += 1
+                    if failures >= self.config.retries:
+                        logging.error(f'Giving up on {url} after {failures} attempts: {e}')
+                        raise
+                    pause = self.failure_pause(failures)
+                    logging.info(f'Sleeping {pause} Seconds: {e}')
+                    self.on_throttle(pause)
+                    continue
+
+            status = response.status_code
+            metrics.status(status)
+            if status == 200:
+                self.on_success()
+                return response
+
+            if status == 202:
+                #BGG queued the request (usually a collection). Ask again on a fixed cadence, this is not an error.
+                logging.info(f'{command} request queued by BGG, retrying in {self.config.queue_retry} Seconds')
+                metrics.count('queued_seconds', self.config.queue_retry)
+                await asyncio.sleep(self.config.queue_retry)
+                continue
+
+            if 400 <= status < 500 and status not in (408, 429):
+                raise bgg_error(status, error_message(response))
+
+            failures += 1
+            if failures >= self.config.retries:
+                raise requests.HTTPError(f'HTTP Status {status}: {error_message(response)}, giving up on {url} after {failures} attempts', response=response)
+            pause = retry_after(response) if status in (429, 503) else None
+            if pause is None:
+                pause = self.failure_pause(failures)
+            logging.info("Sleeping " + str(pause) + " Seconds: " + error_message(response))
+            self.on_throttle(pause)
+
+def get_client(config):
+    if(config.client is None):
+        config.client = bgg_client(config)
+    return config.client
+
+class unrecorded_request(Exception):
+    #Deliberately not a RequestException, the retry loops must not swallow it.
+    pass
+
+class cassette:
+    #Request/response pairs for --record and --replay, one JSON object per line. Each response is
+    #written as soon as it arrives, so a recording cut short is still usable up to that point.
+    #Replay hands out the responses recorded for a url in order and keeps repeating the last one,
+    #so a 202 followed by a 200 replays the same way.
+    def __init__(self, path, mode, latency=0.0):
+        self.path    = path
+        self.mode    = mode
+        self.latency = latency
+        self.lock    = threading.Lock()
+        self.file    = None
+        self.entries = {}
+        self.served  = {}
+        if mode == 'record':
+            self.file = open(path, 'w', encoding="utf-8")
+        else:
+            with open(path, 'r', encoding="utf-8") as file:
+                for line in file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries.setdefault(self.key(entry['method'], entry['url']), []).append(entry)
+            logging.info(f'Replaying {sum(len(entries) for entries in self.entries.values())} responses from {path}')
+
+    def key(self, method, url):
+        return method + ' ' + url
+
+    def record(self, request, response):
+        body = response.content
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in ('content-encoding', 'transfer-encoding', 'content-length')}
+        entry = {'method': request.method, 'url': request.url, 'status': response.status_code, 'reason': response.reason, 'headers': headers}
+        try:
+            entry['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            entry['body_base64'] = base64.b64encode(body).decode('ascii')
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def replay(self, request, adapter):
+        key = self.key(request.method, request.url)
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise unrecorded_request(f'No recorded response for {key} in {self.path}')
+            served = self.served.get(key, 0)
+            self.served[key] = served + 1
+        entry = entries[min(served, len(entries) - 1)]
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        body = base64.b64decode(entry['body_base64']) if 'body_base64' in entry else entry['body'].encode('utf-8')
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason      = entry['reason']
+        response.headers     = requests.structures.CaseInsensitiveDict(entry['headers'])
+        response.headers['Content-Length'] = str(len(body))
+        response.raw         = io.BytesIO(body)
+        response.url         = request.url
+        response.request     = request
+        response.connection  = adapter
+        response.encoding    = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def open_cassette(config):
+    if(config.cassette is None):
+        if(config.record_path):
+            config.cassette = cassette(config.record_path, 'record')
+        elif(config.replay_path):
+            config.cassette = cassette(config.replay_path, 'replay', config.replay_latency)
+    return config.cassette
+
+class recording_adapter(HTTPAdapter):
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        self.cassette.record(request, response)
+        return response
+
+class replay_adapter(HTTPAdapter):
+    #Never opens a connection, every response comes from the cassette.
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        return self.cassette.replay(request, self)
+
+def http_adapter(config, **kwargs):
+    #The transport under every BGG and image request: the network, or a cassette being recorded or replayed.
+    transport = open_cassette(config)
+    if transport is None:
+        return HTTPAdapter(**kwargs)
+    if transport.mode == 'record':
+        return recording_adapter(transport, **kwargs)
+    return replay_adapter(transport, **kwargs)
+
+class game_record:
+    #Everything later stages need about one game, parsed once by load_game_records.
+    __slots__ = ('collection_info', 'fields', 'config', 'first_char', '_game_info')
+
+    def __init__(self, collection_info, fields, config):
+        self.collection_info = collection_info
+        self.fields          = fields
+        self.config          = config
+        self.first_char      = first_char(fields['name']) if fields['name'] is not None else None
+        self._game_info      = None
+
+    #Built on first use, incremental runs only need it for games whose fragment changed.
+    @property
+    def game_info(self):
+        if self._game_info is None:
+            self._game_info = game_information(self.fields, self.config, self.collection_info)
+            self._game_info.local_image, self._game_info.image_size = image_location(self.config, self.collection_info.obj_id)
+        return self._game_info
+
+    @property
+    def image_url(self):
+        return self.collection_info.my_image or self.fields['image']
+
+class image_cache:
+    #Box art stored once per distinct content under its sha256, with a manifest mapping object ids
+    #to blobs. Blobs carry a last used time for LRU eviction against a byte budget, and objects keep
+    #the ETag/Last-Modified of their download so they can be revalidated cheaply.
+    #Runs sharing the images directory lock manifest.lock around reading and writing the manifest and
+    #deleting files, and merge what the other saved. Temp files and unknown blobs younger than
+    #stale_age may be another run's download in progress, so they are left alone.
+    stale_age = 60 * 60
+
+    def __init__(self, config):
+        self.path          = config.images_path
+        self.manifest_path = os.path.join(config.images_path, 'manifest.json')
+        self.budget        = config.image_budget
+        self.lock          = threading.Lock()
+        self.objects       = {}
+        self.blobs         = {}
+        self.removed       = set()
+        if(os.path.exists(self.manifest_path)):
+            try:
+                self.objects, self.blobs = self.read_manifest()
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logging.warning(f'Image manifest {self.manifest_path} is unreadable, starting a new one: {e}')
+                self.objects = {}
+                self.blobs   = {}
+
+    def read_manifest(self):
+        with open(self.manifest_path, 'r', encoding="utf-8") as file:
+            manifest = json.load(file)
+        return manifest['objects'], manifest['blobs']
+
+    @contextlib.contextmanager
+    def manifest_lock(self):
+        #Advisory, and a no-op where fcntl is missing. Closing the file releases it.
+        with open(os.path.join(self.path, 'manifest.lock'), 'a') as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)
+            yield
+
+    def merge(self):
+        #Take in what other runs saved since we read the manifest. Call with the manifest lock held.
+        try:
+            objects, blobs = self.read_manifest()
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        with self.lock:
+            for digest, blob in blobs.items():
+                if digest in self.removed:
+                    continue
+                mine = self.blobs.get(digest)
+                if mine is None:
+                    self.blobs[digest] = blob
+                else:
+                    mine['last_used'] = max(mine['last_used'], blob.get('last_used', 0))
+            for obj_id, entry in objects.items():
+                mine = self.objects.get(obj_id)
+                if entry.get('hash') in self.blobs and (mine is None or entry.get('checked', 0) > mine.get('checked', 0)):
+                    self.objects[obj_id] = entry
+
+    def blob_path(self, digest):
+        return os.path.join(self.path, digest + self.blobs[digest]['ext'])
+
+    def path_for(self, obj_id):
+        entry = self.objects.get(obj_id)
+        if entry is None or entry['hash'] not in self.blobs:
+            return None
+        return self.blob_path(entry['hash'])
+
+    def size_for(self, obj_id):
+        #(width, height) of the cached image, None if unknown.
+        entry = self.objects.get(obj_id)
+        if entry is None or entry['hash'] not in self.blobs:
+            return None
+        blob = self.blobs[entry['hash']]
+        if 'width' not in blob:
+            blob['width'], blob['height'] = read_image_size(self.blob_path(entry['hash'])) or (None, None)
+        if blob['width'] is None:
+            return None
+        return (blob['width'], blob['height'])
+
+    def request_headers(self, obj_id, url, max_age):
+        #None if the cached copy is good as is, otherwise the headers for the request to make.
+        entry = self.objects.get(obj_id)
+        if entry is not None and entry['url'] is None:
+            #Adopted from before the manifest, trust it for whatever url we have now.
+            entry['url'] = url
+        if entry is not None and entry['hash'] in self.blobs and not self.blob_intact(entry['hash']):
+            logging.warning(f'Cached image for {obj_id} is missing or truncated, downloading it again')
+            with self.lock:
+                self.blobs.pop(entry['hash'], None)
+        if entry is None or entry['hash'] not in self.blobs or entry['url'] != url:
+            #Another game may already have downloaded the same url.
+            with self.lock:
+                for other in self.objects.values():
+                    if other['url'] == url and other['hash'] in self.blobs:
+                        self.objects[obj_id] = dict(other)
+                        self.touch(obj_id)
+                        return None
+            return {}
+        self.touch(obj_id)
+        if max_age <= 0 or time.time() - entry.get('checked', 0) < max_age:
+            return None
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def blob_intact(self, digest):
+        try:
+            return os.path.getsize(self.blob_path(digest)) == self.blobs[digest]['size']
+        except OSError:
+            return False
+
+    def touch(self, obj_id):
+        #The clock is read at each use, a --serve cache lives for days.
+        self.blobs[self.objects[obj_id]['hash']]['last_used'] = time.time()
+
+    def revalidated(self, obj_id):
+        with self.lock:
+            self.objects[obj_id]['checked'] = time.time()
+
+    def store(self, obj_id, url, temp_path, digest, ext, response):
+        now = time.time()
+        with self.lock:
+            if digest in self.blobs:
+                #Same bytes as an image we already have.
+                os.remove(temp_path)
+            else:
+                self.blobs[digest] = {'ext': ext, 'size': os.path.getsize(temp_path), 'last_used': now}
+                os.replace(temp_path, self.blob_path(digest))
+            self.blobs[digest]['last_used'] = now
+            self.objects[obj_id] = {
+                'hash':          digest,
+                'url':           url,
+                'etag':          response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'checked':       now,
+            }
+
+    def migrate_legacy(self):
+        #Images from before the manifest were stored as <objid>.jpg, adopt them.
+        for f in os.listdir(self.path):
+            obj_id, ext = os.path.splitext(f)
+            if not obj_id.isdigit() or obj_id in self.objects:
+                continue
+            path = os.path.join(self.path, f)
+            with open(path, 'rb') as file:
+                digest = hashlib.sha256(file.read()).hexdigest()
+            if digest in self.blobs:
+                os.remove(path)
+            else:
+                self.blobs[digest] = {'ext': ext, 'size': os.path.getsize(path), 'last_used': time.time()}
+                os.replace(path, self.blob_path(digest))
+            self.objects[obj_id] = {'hash': digest, 'url': None, 'etag': None, 'last_modified': None, 'checked': 0}
+
+    def recover(self):
+        #Clean up after a run that died: drop half written downloads, and adopt box art stored after the
+        #last manifest checkpoint so eviction accounts for it and a fresh download of the same bytes reuses it.
+        cutoff = time.time() - self.stale_age
+        with self.manifest_lock():
+            for f in os.listdir(self.path):
+                digest, ext = os.path.splitext(f)
+                path = os.path.join(self.path, f)
+                try:
+                    modified = os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                if f.startswith('.') and f.endswith('.tmp'):
+                    if modified < cutoff:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(path)
+                elif len(digest) == 64 and digest not in self.blobs and all(c in '0123456789abcdef' for c in digest):
+                    self.blobs[digest] = {'ext': ext, 'size': os.path.getsize(path), 'last_used': modified}
+
+    def evict(self):
+        #Unreferenced blobs go first, then least recently used until we are under budget.
+        cutoff = time.time() - self.stale_age
+        with self.manifest_lock():
+            self.merge()
+            referenced = {entry['hash'] for entry in self.objects.values()}
+            total      = sum(blob['size'] for blob in self.blobs.values())
+            order      = sorted(self.blobs, key=lambda digest: (digest in referenced, self.blobs[digest]['last_used']))
+            evicted    = 0
+            for digest in order:
+                if digest in referenced and (self.budget <= 0 or total <= self.budget):
+                    break
+                if digest not in referenced and self.blobs[digest]['last_used'] > cutoff:
+                    #Maybe another run's download that is not in its manifest yet.
+                    continue
+                total -= self.blobs[digest]['size']
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.blob_path(digest))
+                del self.blobs[digest]
+                self.removed.add(digest)
+                evicted += 1
+            if evicted:
+                self.objects = {obj_id: entry for obj_id, entry in self.objects.items() if entry['hash'] in self.blobs}
+                logging.info(f'Evicted {evicted} images, cache is {total // (1024 * 1024)} MB')
+
+    def save(self):
+        #Also called as a checkpoint while downloads are still running.
+        with self.manifest_lock():
+            self.merge()
+            with self.lock:
+                manifest = json.dumps({'objects': self.objects, 'blobs': self.blobs})
+            atomic_write(self.manifest_path, manifest)
+
+def open_image_cache(config):
+    if(config.image_cache is None):
+        os.makedirs(config.images_path, exist_ok=True)
+        config.image_cache = image_cache(config)
+    return config.image_cache
+
+def image_location(config, obj_id):
+    #Where the page should load a game's box art from and its (width, height), None when it has to come from BGG.
+    if(config.no_cache or config.image_cache is None):
+        return (None, None)
+    return (config.image_cache.path_for(obj_id), config.image_cache.size_for(obj_id))
+
+def read_image_size(path):
+    #Pixel size from the PNG, GIF or JPEG header, without decoding the image.
+    try:
+        with open(path, 'rb') as file:
+            head = file.read(26)
+            if head.startswith(b'\x89PNG\r\n\x1a\n'):
+                return struct.unpack('>II', head[16:24])
+            if head[:6] in (b'GIF87a', b'GIF89a'):
+                return struct.unpack('<HH', head[6:10])
+            if not head.startswith(b'\xff\xd8'):
+                return None
+            #Walk the JPEG segments to the start-of-frame marker.
+            file.seek(2)
+            while True:
+                marker = file.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                while marker[1] == 0xFF:
+                    marker = marker[1:] + file.read(1)
+                length = struct.unpack('>H', file.read(2))[0]
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack('>xHH', file.read(5))
+                    return (width, height)
+                file.seek(length - 2, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return None
+
+class run_journal:
+    #Which collections the run in progress has fetched, next to the metadata database. Game data, box
+    #art and incremental fragments are kept as they arrive anyway, the collection is the one thing an
+    #--incremental run would otherwise request again, so --resume reuses the interrupted run's copy.
+    #A run that finishes removes the journal.
+    def __init__(self, path, users, resume):
+        self.path    = path
+        self.lock    = threading.Lock()
+        previous     = self.load(users)
+        self.resumed = resume and previous is not None
+        if self.resumed:
+            self.state = previous
+            logging.warning(f'Resuming the run started {datetime.fromtimestamp(previous["started"])}, '
+                            f'reusing the collections of {", ".join(previous["collections"]) or "nobody yet"}')
+        else:
+            if previous is not None:
+                logging.warning(f'The last run for {", ".join(users)} did not finish, use --resume to reuse the collections it fetched')
+            self.state = {'users': users, 'started': time.time(), 'collections': []}
+        self.save()
+
+    def load(self, users):
+        #None unless there is a readable journal from an unfinished run for the same users.
+        try:
+            with open(self.path, 'r', encoding="utf-8") as file:
+                state = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning(f'Ignoring unreadable run journal {self.path}: {e}')
+            return None
+        if not isinstance(state, dict) or state.get('users') != users:
+            return None
+        if not isinstance(state.get('started'), (int, float)) or not isinstance(state.get('collections'), list):
+            logging.warning(f'Ignoring unreadable run journal {self.path}')
+            return None
+        return state
+
+    def has_collection(self, user_name):
+        return self.resumed and user_name in self.state['collections']
+
+    def add_collection(self, user_name):
+        with self.lock:
+            self.state['collections'].append(user_name)
+            self.save()
+
+    def save(self):
+        atomic_write(self.path, json.dumps(self.state))
+
+    def finish(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+def journal_collection(config):
+    #config.collection_xml is complete, a --resume of this run can use it as is.
+    if(config.journal is not None):
+        config.journal.add_collection(config.user_name)
+
+def sync_file(file):
+    #Push a finished temp file to disk before it is renamed over the real one, so a crash leaves
+    #either the old file or the complete new one.
+    file.flush()
+    os.fsync(file.fileno())
+
+def atomic_write(path, text):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding="utf-8") as file:
+            file.write(text)
+            sync_file(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+def collection_complete(path):
+    #A collection file cut short by an old crash would stop iterparse partway, check it ends properly.
+    try:
+        with open(path, 'rb') as file:
+            file.seek(max(0, os.path.getsize(path) - 64))
+            return file.read().rstrip().endswith(b'</items>')
+    except OSError:
+        return False
+
+class thing_planner:
+    #Splits the ids to fetch into thing requests and adapts to what BGG accepts. The batch size is
+    #binary searched between the largest size that worked and the smallest that was refused (or
+    #taken straight from a "Cannot load more than N items" message). Only a limit BGG actually
+    #imposed is remembered in the store, and only for --ttl, so later runs probe upwards again.
+    #A refused batch no bigger than one that worked is bisected until the offending id is on its
+    #own. Ids missing from a good response are recorded as missing.
+    def __init__(self, config, obj_ids):
+        self.config  = config
+        self.store   = open_store(config)
+        self.pending = collections.deque(obj_ids)
+        self.splits  = collections.deque()
+        self.size    = config.thing_batch
+        learned      = self.store.get_setting('thing_batch_limit')
+        learned_at   = self.store.get_setting('thing_batch_limit_at')
+        if learned and learned_at and (config.ttl <= 0 or float(learned_at) >= time.time() - config.ttl):
+            self.size = min(int(learned), config.thing_batch)
+        self.good    = 0
+        self.refused = None
+        self.limit   = None
+        self.bad_ids = False
+        self.missing = []
+
+    def next_batch(self):
+        if self.splits:
+            return self.splits.popleft()
+        batch = []
+        while self.pending and len(batch) < self.size:
+            batch.append(self.pending.popleft())
+        return batch
+
+    def requeue(self, batch):
+        self.pending.extendleft(reversed(batch))
+
+    def succeeded(self, batch, stored):
+        self.good = max(self.good, len(batch))
+        if self.refused is not None and self.refused - self.good > 1:
+            self.size = (self.good + self.refused) // 2
+        returned = set(stored)
+        self.missing.extend(obj_id for obj_id in batch if obj_id not in returned)
+
+    def refused_batch(self, batch, error):
+        limit = re.search(r'more than (\d+)', error.message or '')
+        if limit and int(limit.group(1)) < len(batch):
+            #BGG told us the limit. Other requests in flight may report the same thing.
+            if self.refused != int(limit.group(1)) + 1:
+                logging.warning(f'BGG accepts at most {limit.group(1)} ids per thing request')
+            self.good    = int(limit.group(1))
+            self.limit   = self.good
+            self.refused = self.good + 1
+            self.size    = self.good
+            self.requeue(batch)
+        elif len(batch) > max(1, self.good):
+            #Bigger than anything that has worked, take it as too big.
+            if self.refused is None or len(batch) < self.refused:
+                self.refused = len(batch)
+            self.size = (self.good + self.refused) // 2 if self.good else max(1, len(batch) // 2)
+            logging.info(f'Thing request for {len(batch)} ids refused ({error}), trying {self.size}')
+            self.requeue(batch)
+        elif len(batch) > 1:
+            #A size that has worked before, so one of these ids is the problem.
+            logging.info(f'Thing request for {len(batch)} ids refused ({error}), splitting it')
+            half = len(batch) // 2
+            self.splits.extendleft([batch[half:], batch[:half]])
+        else:
+            logging.warning(f'BGG refused thing {batch[0]} ({error}), skipping it')
+            self.bad_ids = True
+            self.missing.extend(batch)
+
+    def finish(self):
+        #Can be called again after more ids were queued. Sizes that were only as small as the ids
+        #pending are not a limit. A bare refusal is only taken as one when no single id was refused
+        #as well, or a bad id in a small batch could pass for a size limit.
+        bound = self.limit
+        if bound is None and self.refused is not None and not self.bad_ids:
+            bound = self.refused - 1
+        if bound is not None:
+            self.store.put_setting('thing_batch_limit', max(1, bound))
+            self.store.put_setting('thing_batch_limit_at', time.time())
+        if self.missing:
+            logging.warning(f'BGG has no data for {len(self.missing)} ids, skipping them on later runs: {", ".join(self.missing[:20])}')
+            self.store.put_missing(self.missing)
+            self.missing = []
+
+class unknown_user(Exception):
+    pass
+
+class page_cache:
+    #Warm state for --serve. Parsed records stay in memory per user and finished pages per
+    #(user, cardmode, own), so a repeat view is a dictionary lookup. Concurrent requests for a page
+    #that is being built wait for that build instead of starting their own. Builds run one at a time
+    #because the client, metadata store and image cache are shared.
+    def __init__(self, config):
+        self.config     = config
+        self.lock       = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.users      = {}
+        self.pages      = {}
+        self.building   = {}
+        self.templates  = {}
+        #Open the shared pieces on the base config so every per page copy of it uses them.
+        get_client(config)
+        open_store(config)
+        if not (config.no_cache):
+            open_image_cache(config)
+
+    def page(self, user_name, card_mode, own):
+        #Returns (etag, body) for the page.
+        key = (user_name.lower(), card_mode, own)
+        with self.lock:
+            if key in self.pages:
+                return self.pages[key]
+            future = self.building.get(key)
+            owner  = future is None
+            if owner:
+                future = self.building[key] = Future()
+        if not owner:
+            return future.result()
+
+        try:
+            page = self.build(user_name, card_mode, own)
+        except BaseException as e:
+            with self.lock:
+                del self.building[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.pages[key] = page
+            del self.building[key]
+        future.set_result(page)
+        return page
+
+    def variant(self, user_name, card_mode, own):
+        user = user_config(self.config, user_name)
+        user.card_mode = card_mode
+        user.only_own  = own
+        user.web_mode  = False
+        if card_mode not in self.templates:
+            user.compiled_template = None
+            self.templates[card_mode] = load_template(user)
+        user.compiled_template = self.templates[card_mode]
+        return user
+
+    def load_user(self, user_name):
+        #Every game the user has, ownership is filtered per page.
+        user = self.variant(user_name, False, False)
+        root = parse_xml(bgg_getter('user', {'name': user_name}, user).content)
+        if not root.attrib.get('id'):
+            raise unknown_user(user_name)
+        if(user.no_cache or not collection_complete(user.collection_xml)):
+            request_collection(user)
+        self.load_records(user)
+
+    def load_records(self, user):
+        records = load_game_records(user, iterate_collection(user, user.collection_xml))
+        download_images(user, records)
+        state = collection_state(record.collection_info for record in records)
+        with self.lock:
+            self.users[user.user_name.lower()] = {'records': records, 'state': state}
+            #Pages built from the old records are stale.
+            for key in [key for key in self.pages if key[0] == user.user_name.lower()]:
+                del self.pages[key]
+
+    def build(self, user_name, card_mode, own):
+        with self.build_lock:
+            if user_name.lower() not in self.users:
+                self.load_user(user_name)
+            user    = self.variant(user_name, card_mode, own)
+            #game_information depends on the card mode, so each page gets its own records.
+            records = [game_record(record.collection_info, record.fields, user) for record in self.users[user_name.lower()]['records']
+                       if not own or record.collection_info.own]
+            buffer = io.StringIO()
+            write_single_document(user, buffer, records)
+            body = buffer.getvalue().encode('utf-8')
+        logging.info(f'Built {user_name} cardmode={int(card_mode)} own={int(own)}, {len(records)} games')
+        return ('"' + hashlib.sha256(body).hexdigest()[:32] + '"', body)
+
+    def refresh(self):
+        #Refetch every known user's collection and any stale game data, reloading users whose data changed.
+        for user_name in list(self.users):
+            with self.build_lock:
+                user    = self.variant(user_name, False, False)
+                records = self.users[user_name]['records']
+                stale   = []
+                if(not user.no_cache and user.ttl > 0):
+                    stale = open_store(user).stale_ids([record.collection_info.obj_id for record in records], time.time() - user.ttl, user.max_refresh)
+                if stale:
+                    refresh_games(user, stale)
+                request_collection(user)
+                if stale or collection_state(iterate_collection(user, user.collection_xml)) != self.users[user_name]['state']:
+                    logging.info(f'Reloading {user_name}')
+                    self.load_records(user)
 
 ######### End Classes #########
 
@@ -97,48 +1352,55 @@ articles = [
 "Le"
 ]
 
+#lxml parses and queries much faster when it is installed, ElementTree is the fallback. --no_lxml switches back.
+xml_backend = lxml_etree or ElementTree
+xml_errors  = (ElementTree.ParseError,) + ((lxml_etree.XMLSyntaxError,) if lxml_etree else ())
+
+#One pass over a thing <item> pulling every field thing_fields needs, see lxml_thing_fields.
+thing_xpath = lxml_etree.XPath('name[1] | image | yearpublished | minplayers | maxplayers | minplaytime | maxplaytime'
+                               ' | description | link | statistics/ratings/averageweight') if lxml_etree else None
+
+#Box art used when BGG has no image for a game.
+default_image_url = "https://cf.geekdo-images.com/zxVVmggfpHJpmnJY9j-k1w__imagepagezoom/img/RO6wGyH4m4xOJWkgv6OVlf6GbrA=/fit-in/1200x900/filters:no_upscale():strip_icc()/pic1657689.jpg"
+
 ######### End Globals #########
 
 
 ######### Begin Functions #########
 
+def retry_after(response):
+    #Retry-After is either a number of seconds or an HTTP date.
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (when - datetime.now(when.tzinfo)).total_seconds())
+
+def error_message(response):
+    try:
+        return parse_xml(response.content).find('message').text
+    except xml_errors + (AttributeError,):
+        return "HTTP Status " + str(response.status_code)
+
 #command is an api command from BGG (user, collection, etc)
 #params is a dictionary with parameter/value pairs for the command
-def bgg_getter (command, params, config):
-    sleep(.3)
-    status = 0
-    a = ''
-    while not status == 200:
-        url = '{}/{}?{}'.format(config.bgg,
-                                quote(command),
-                                urlencode(params),
-                                )
-        logging.debug(url)
-        a = requests.get(url)
-        status = a.status_code
-        if(status != 200):
-            error = ElementTree.fromstring(a.content)
-            try:
-                err_msg = error.find('message').text
-            except:
-                err_msg = "HTTP Status " + str(status)
-            logging.info("Sleeping " + str(config.sleep_time) + " Seconds: " + (err_msg))
-            sleep(config.sleep_time)
-            config.sleep_time *= 2
-            config.sleep_time = min(config.sleep_time_max,config.sleep_time)
-            config.successful_responses = 0
-        else:
-            config.successful_responses += 1
-            if(config.successful_responses % 15 == 0):
-                config.sleep_time /= 2
-                config.sleep_time = max(10,config.sleep_time)
-    return a
+#stream leaves the body of a successful response unread, for write_response_to_file
+def bgg_getter (command, params, config, stream=False):
+    return asyncio.run(get_client(config).get(command, params, stream))
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Create html output of a board game collection based on UserName from boardgamegeek.com.')
     parser.add_argument('-u','--username', dest='username', action='store', default='', help='User to pull BGG collection data from. (Required)')
+    parser.add_argument('-b','--batch', dest='batch', action='store', default='', help='Comma separated list of users to build in one run, sharing downloads. Writes one output per user.')
     parser.add_argument('-c','--cardmode', dest='cardmode', action='store_true', help='Create cards instead of a catalog. (default=Off)')
-    parser.add_argument('-i','--index', dest='index', action='store_true', help='Enables creating an index. (default=Off)')
+    parser.add_argument('-i','--index', dest='index', action='store_true', help='Enables creating an index by player count, category, mechanic, designer, weight and playtime. (default=Off)')
     parser.add_argument('-n','--navigation', dest='navigation', action='store_true', help='Create alphabetical navigation links. (default=Off)')
     parser.add_argument('--clean_images', dest='clean_images', action='store_true', help='Clear out local images cache. (default=Off)')
     parser.add_argument('--clean_xml', dest='clean_xml', action='store_true', help='Clear out local xml cache. (default=Off)')
@@ -146,21 +1408,63 @@ def parse_arguments():
     parser.add_argument('-o','--own',dest='own', action='store_true', help='Enables pulling only games set to own on BGG. (default=Off)')
     parser.add_argument('--minsleep', dest='minsleep', action='store', default='', help='Minimum sleep duration on XML error. (Default=10)')
     parser.add_argument('--maxsleep', dest='maxsleep', action='store', default='', help='Maximum sleep duration on XML error. (Default=120)')
+    parser.add_argument('--retries', dest='retries', action='store', default='', help='Failed attempts at a BGG request before the run gives up, the pause doubles from minsleep to maxsleep between them. (Default=10)')
+    parser.add_argument('--rate', dest='rate', action='store', default='', help='Maximum BGG API requests per second. (Default=2)')
+    parser.add_argument('--bgg_url', dest='bgg_url', action='store', default='', help='BGG XML API base url, for testing against a local server. (Default="https://boardgamegeek.com/xmlapi2")')
+    parser.add_argument('--concurrency', dest='concurrency', action='store', default='', help='BGG API requests kept in flight at once. (Default=3)')
     parser.add_argument('--output', dest='output', action='store', default='', help='Output html file. (Default="./output.html")')
     parser.add_argument('--images_path', dest='images_path', action='store', default='', help='Images path. (Default="./Images")')
-    parser.add_argument('--xml_path', dest='xml_path', action='store', default='', help='Game XML Path. (Default="./game_xml")')
+    parser.add_argument('--xml_path', dest='xml_path', action='store', default='', help='Old game XML cache path, migrated into the metadata database. (Default="./game_xml")')
+    parser.add_argument('--metadata_db', dest='metadata_db', action='store', default='', help='Game metadata cache database. (Default="./game_xml.sqlite")')
     parser.add_argument('--collection_xml', dest='collection_xml', action='store', default='', help='Output collection XML file.(Default="./collection.xml")')
     parser.add_argument('--no_cache', dest='no_cache', action='store_true', help='Turn off all caching (default=Off)')
-    return parser.parse_args()
+    parser.add_argument('--ttl', dest='ttl', action='store', default='', help='Days before cached game data is refreshed in the background, 0 never refreshes. (Default=30)')
+    parser.add_argument('--max_refresh', dest='max_refresh', action='store', default='', help='Maximum stale games refreshed per run. (Default=50)')
+    parser.add_argument('-j','--jobs', dest='jobs', action='store', default='', help='Worker processes used to render games. (Default=1)')
+    parser.add_argument('--json', dest='json', action='store_true', help='Write the games as compact JSON next to the output, and an output page that renders them in the browser with sorting and filtering. (default=Off)')
+    parser.add_argument('--metrics', dest='metrics', action='store', default='', help='Write per stage timings and request, retry, backoff, cache and output counters to this JSON file. (default=Off)')
+    parser.add_argument('--record', dest='record', action='store', default='', help='Save every BGG and image response to this cassette file. (default=Off)')
+    parser.add_argument('--replay', dest='replay', action='store', default='', help='Answer every BGG and image request from this cassette file instead of the network, unrecorded requests are an error. (default=Off)')
+    parser.add_argument('--replay_latency', dest='replay_latency', action='store', default='', help='Seconds added to each replayed response. (Default=0)')
+    parser.add_argument('--serve', dest='serve', action='store', default='', help='Run a web server on this port serving /user/<name>?cardmode=1&own=1 from memory. (default=Off)')
+    parser.add_argument('--serve_refresh', dest='serve_refresh', action='store', default='', help='Minutes between background collection refreshes in server mode. (Default=60)')
+    parser.add_argument('--watch', dest='watch', action='store_true', help='Keep running after the output is written and rewrite it from memory whenever the template or CSS files change. (default=Off)')
+    parser.add_argument('--no_lxml', dest='no_lxml', action='store_true', help='Parse XML with ElementTree even when lxml is installed. (default=Off)')
+    parser.add_argument('--resume', dest='resume', action='store_true', help='Reuse the collection XML an interrupted run already fetched instead of requesting it again. (default=Off)')
+    parser.add_argument('--paged', dest='paged', action='store_true', help='Write one page per navigation letter plus a landing page, for very large collections. (default=Off)')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help='Refetch the collection and only re-render games that changed. (default=Off)')
+    parser.add_argument('--image_budget', dest='image_budget', action='store', default='', help='Image cache size limit in MB, least recently used images are evicted first, 0 for no limit. (Default=1024)')
+    parser.add_argument('--image_threads', dest='image_threads', action='store', default='', help='Parallel image downloads, also the connection limit per image host. (Default=8)')
+    args = parser.parse_args()
+    if(args.record and args.replay):
+        parser.error('--record and --replay can not be used together')
+    if(args.watch and (args.batch or args.serve)):
+        parser.error('--watch can not be used with --batch or --serve')
+    return args
 
 def get_value(item):
     return item.attrib['value']
 
-def get_value_in_list(item, i):
-    if(len(item) <= i):
+def get_value_in_list(values, i):
+    if(len(values) <= i):
         return None
     else:
-        return item[i].attrib['value']
+        return values[i]
+
+def parse_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def format_number(value):
+    return "" if value is None else str(value)
 
 def get_prop_text(elem, name):
     elem = elem.find(name)
@@ -172,14 +1476,90 @@ def get_prop_value(elem, name):
     if elem is not None:
         return get_value(elem)
 
-def get_links(elem, name):
-    values = []
-    elem = elem.findall('link')
-    for item in elem:
-        if (item.attrib['type'] == name):
-            if item is not None:
-                values.append(item)
-    return values
+def get_links(elem):
+    #Group every link value by its type in a single pass over the item.
+    links = {}
+    for item in elem.findall('link'):
+        links.setdefault(item.attrib['type'], []).append(item.attrib['value'])
+    return links
+
+def thing_fields(item):
+    #Everything we use from a thing <item>, as stored in the metadata database.
+    return {
+        'obj_id':        item.attrib['id'],
+        'type':          item.attrib['type'],
+        'name':          get_prop_value(item, 'name'),
+        'image':         get_prop_text(item, 'image'),
+        'yearpublished': get_prop_value(item, 'yearpublished'),
+        'minplayers':    get_prop_value(item, 'minplayers'),
+        'maxplayers':    get_prop_value(item, 'maxplayers'),
+        'minplaytime':   get_prop_value(item, 'minplaytime'),
+        'maxplaytime':   get_prop_value(item, 'maxplaytime'),
+        'weight':        item.find('statistics').find('ratings').find('averageweight').attrib['value'],
+        'links':         get_links(item),
+        'description':   get_prop_text(item, 'description'),
+    }
+
+def lxml_thing_fields(item):
+    #thing_fields in one XPath query, dispatching on each matched element instead of a find per field.
+    get    = item.get
+    fields = {'obj_id': get('id'), 'type': get('type'), 'name': None, 'image': None, 'yearpublished': None, 'minplayers': None,
+              'maxplayers': None, 'minplaytime': None, 'maxplaytime': None, 'links': {}, 'description': None}
+    links = fields['links']
+    for elem in thing_xpath(item):
+        tag = elem.tag
+        if tag == 'link':
+            links.setdefault(elem.get('type'), []).append(elem.get('value'))
+        elif tag == 'averageweight':
+            fields['weight'] = elem.get('value')
+        elif tag == 'image' or tag == 'description':
+            fields[tag] = elem.text
+        else:
+            fields[tag] = elem.get('value')
+    #The same errors ElementTree's lookups give for a malformed thing.
+    if fields['obj_id'] is None or fields['type'] is None:
+        raise KeyError('id')
+    if 'weight' not in fields:
+        raise AttributeError('thing ' + fields['obj_id'] + ' has no averageweight')
+    return fields
+
+def use_etree():
+    global xml_backend
+    xml_backend = ElementTree
+
+def parse_xml(content):
+    return xml_backend.fromstring(content)
+
+def item_sources(content):
+    #The raw <item>...</item> slices of a thing response. Thing items never nest.
+    sources = []
+    end = 0
+    while True:
+        start = content.find(b'<item ', end)
+        if start < 0:
+            return sources
+        end = content.find(b'</item>', start)
+        if end < 0:
+            return sources
+        end += len(b'</item>')
+        sources.append(content[start:end])
+
+def thing_records(content):
+    #thing_fields, plus the item's own XML, for each <item> of a thing response body (bytes).
+    root   = parse_xml(content)
+    items  = [root] if root.tag == 'item' else [child for child in root if child.tag == 'item']
+    fields = lxml_thing_fields if xml_backend is lxml_etree else thing_fields
+    #Slicing the body is far cheaper than serializing every subtree again. Fall back to that if
+    #the slices don't line up with the parsed items.
+    sources = item_sources(content)
+    if len(sources) != len(items):
+        sources = [xml_backend.tostring(item, encoding='utf-8') for item in items]
+    records = []
+    for item, source in zip(items, sources):
+        record = fields(item)
+        record['xml'] = source.decode('utf-8')
+        records.append(record)
+    return records
 
 def open_template(config):
     if(config.card_mode):
@@ -189,6 +1569,13 @@ def open_template(config):
         with open(config.template, 'r') as file:
             return file.read()
 
+def load_template(config):
+    #Read and compile the template once per run.
+    if(config.compiled_template is None):
+        path = config.card_template if config.card_mode else config.template
+        config.compiled_template = compiled_template(open_template(config), path)
+    return config.compiled_template
+
 def get_mechanics_list_max_length(config):
     if(config.card_mode):
         return 65
@@ -201,31 +1588,37 @@ def get_description_length(config):
     else:
         return 1000
 
-def template_to_output_entry(config, game_info, anchor):
-    mechanics_list_max_length = get_mechanics_list_max_length(config)
-
-    #Read the template.
-    template = open_template(config)
+def combined_rating(game_info):
+    #The user's own rating, when there is one, is averaged with BGG's.
+    if game_info.my_rating is None:
+        return game_info.avg_rating
+    return (game_info.avg_rating + game_info.my_rating) / 2
 
-    #Replace values in the template.
-    if (anchor):
-        template = template.replace('{{anchor}}'    , 'id="' + anchor + '"')
-    else:
-        template = template.replace('{{anchor}}'    , "")
-
-    if(config.no_cache):
-        template = template.replace('{{image}}'     , game_info.image or "")
-    else:
-        template = template.replace('{{image}}'     , os.path.join(config.images_path, game_info.obj_id + ".jpg") or "")
+def template_values(config, game_info, anchor):
+    mechanics_list_max_length = get_mechanics_list_max_length(config)
 
-    template = template.replace('{{BGGLink}}'       , "https://www.boardgamegeek.com/boardgame/" + game_info.obj_id)
-    template = template.replace('{{GameName}}'      , game_info.name                            or "N/A")
-    template = template.replace('{{Description}}'   , game_info.description                     or "N/A")
-    template = template.replace('{{Published}}'     , game_info.published                       or "N/A")
-    template = template.replace('{{Publisher}}'     , game_info.publisher                       or "N/A")
-    template = template.replace('{{Designer}}'      , game_info.designer                        or "N/A")
-    template = template.replace('{{Artist}}'        , game_info.artist1                         or "N/A")
-    template = template.replace('{{Category}}'      , (game_info.category1                      or "") + "<br/>" + (game_info.category2 or ""))
+    values = {}
+    values['anchor']      = 'id="' + anchor + '"' if anchor else ""
+
+    #Fall back to BGG's copy for --no_cache, or an image we could not download.
+    values['image']       = game_info.local_image or game_info.image or ""
+
+    #Explicit dimensions let the browser lay the page out before images arrive, paged output also loads them lazily.
+    attributes = []
+    if game_info.image_size is not None:
+        attributes.append(f' width="{game_info.image_size[0]}" height="{game_info.image_size[1]}"')
+    if config.paged:
+        attributes.append(' loading="lazy" decoding="async"')
+    values['image_attributes'] = "".join(attributes)
+
+    values['BGGLink']     = "https://www.boardgamegeek.com/boardgame/" + game_info.obj_id
+    values['GameName']    = game_info.name                            or "N/A"
+    values['Description'] = game_info.description                     or "N/A"
+    values['Published']   = game_info.published                       or "N/A"
+    values['Publisher']   = game_info.publisher                       or "N/A"
+    values['Designer']    = game_info.designer                        or "N/A"
+    values['Artist']      = game_info.artist1                         or "N/A"
+    values['Category']    = (game_info.category1                      or "") + "<br/>" + (game_info.category2 or "")
 
     if (mechanics_list_max_length >= game_info.four_mechanics_length):
         mechanics = [game_info.mechanic1, game_info.mechanic2, game_info.mechanic3, game_info.mechanic4]
@@ -234,31 +1627,102 @@ def template_to_output_entry(config, game_info, anchor):
     else:
         mechanics = [game_info.mechanic1, game_info.mechanic2]
 
-    template = template.replace('{{Mec}}', ",".join(item for item in mechanics if item))
-    template = template.replace('{{p}}'             , game_info.minplayers + " - " + game_info.maxplayers)
-    template = template.replace('{{d}}', str(game_info.mintime) + " - " + str(game_info.maxtime) if (int(game_info.mintime) < int(game_info.maxtime)) else str(game_info.mintime))
-    template = template.replace('{{Weight}}'        , str(round(float(game_info.avg_weight) * 2, 1) )) #Weight is doubled to be on the same scale with rating.
-    template = template.replace('{{Rating}}', str(round(float(game_info.avg_rating), 1)) if ("N/A" in game_info.my_rating) else str(round((float(game_info.avg_rating) + float(game_info.my_rating)) / 2, 1)))
-
-    #Write to output.html
-    with open(config.output, 'a', encoding="utf-8") as file:
-        file.write(template)
-
-def download_image(config, game_info):
-    if not (config.no_cache):
-        #If we have a local cache of the image, then don't try to redownload it, use the local copy.
-        if(os.path.exists(os.path.join(config.images_path, game_info.obj_id + ".jpg")) == False):
-            #Download the image to the local cache.
-            if (game_info.image is None):
-                logging.warning(game_info.name + " has no image url")
-                game_info.image = "https://cf.geekdo-images.com/zxVVmggfpHJpmnJY9j-k1w__imagepagezoom/img/RO6wGyH4m4xOJWkgv6OVlf6GbrA=/fit-in/1200x900/filters:no_upscale():strip_icc()/pic1657689.jpg"
-            res = requests.get(game_info.image, stream = True)
-            if res.status_code == 200:
-                logging.info("Writing: " + collection_info.game_name + " boxart to " + os.path.join(config.images_path, game_info.obj_id + ".jpg"))
-                with open(os.path.join(config.images_path, game_info.obj_id + ".jpg"), 'wb') as f:
-                    shutil.copyfileobj(res.raw, f)
-            else:
-                logging.error("Error downloading image: " + game_info.image + ", status=" + res.status_code)
+    values['Mec']         = ",".join(item for item in mechanics if item)
+    values['p']           = format_number(game_info.minplayers) + " - " + format_number(game_info.maxplayers)
+    values['d']           = format_number(game_info.mintime) + " - " + format_number(game_info.maxtime) if (game_info.mintime is not None and game_info.maxtime is not None and game_info.mintime < game_info.maxtime) else format_number(game_info.mintime)
+    values['Weight']      = str(round(game_info.avg_weight * 2, 1) ) #Weight is doubled to be on the same scale with rating.
+    values['Rating']      = str(round(combined_rating(game_info), 1))
+    return values
+
+def render_entry(config, game_info, anchor):
+    return load_template(config).render(template_values(config, game_info, anchor))
+
+def image_session(config):
+    #One pooled session for all image downloads. pool_block keeps each host to image_threads connections.
+    session = requests.Session()
+    adapter = http_adapter(config, pool_connections=4, pool_maxsize=config.image_threads, pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def download_image(config, cache, obj_id, url, session):
+    #Returns None on success, otherwise a description of the failure.
+    headers = cache.request_headers(obj_id, url, config.ttl)
+
+    #If we have a usable local copy of the image, then don't try to redownload it.
+    if headers is None:
+        config.metrics.count('image_cache_hits')
+        return None
+
+    try:
+        config.metrics.count('image_requests')
+        with session.get(url, headers = headers, stream = True, timeout = 60) as res:
+            if res.status_code == 304:
+                config.metrics.count('image_revalidated')
+                cache.revalidated(obj_id)
+                return None
+            if res.status_code != 200:
+                return "Error downloading image: " + url + ", status=" + str(res.status_code)
+            config.metrics.count('image_cache_misses')
+
+            #Stream to a temp file, hashing as we go, the cache renames it into place.
+            ext = os.path.splitext(urlparse(url).path)[1].lower() or ".jpg"
+            fd, temp_path = tempfile.mkstemp(prefix='.' + obj_id + '.', suffix='.tmp', dir=cache.path)
+            digest = hashlib.sha256()
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in res.iter_content(chunk_size=64 * 1024):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        config.metrics.count('image_bytes', len(chunk))
+                    sync_file(f)
+                cache.store(obj_id, url, temp_path, digest.hexdigest(), ext, res)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp_path)
+                raise
+    except (requests.RequestException, OSError) as e:
+        return "Error downloading image: " + url + ", " + str(e)
+
+    logging.info("Writing: " + obj_id + " boxart to " + cache.path_for(obj_id))
+    return None
+
+def download_images(config, records):
+    #Bring the image cache up to date for every game on a bounded thread pool.
+    if(config.no_cache):
+        return
+
+    cache = open_image_cache(config)
+    cache.recover()
+    cache.migrate_legacy()
+    games = []
+    for record in records:
+        url = record.image_url
+        if (url is None):
+            logging.warning(record.fields['name'] + " has no image url")
+            url = default_image_url
+        games.append((record.collection_info.obj_id, url))
+
+    results = []
+    with image_session(config) as session, ThreadPoolExecutor(max_workers=config.image_threads) as pool:
+        for result in pool.map(lambda game: download_image(config, cache, game[0], game[1], session), games):
+            results.append(result)
+            #Save the manifest now and then, so box art downloaded before a crash is known to the next run.
+            if(len(results) % config.checkpoint_every == 0):
+                cache.save()
+
+    failures = [error for error in results if error is not None]
+    config.metrics.count('image_failures', len(failures))
+    for error in failures:
+        logging.error(error)
+    logging.info(f'Images: {len(games) - len(failures)} available, {len(failures)} failed')
+
+    #Record image dimensions while we are here so later runs don't need to read the headers again.
+    for obj_id, url in games:
+        cache.size_for(obj_id)
+
+    cache.evict()
+    cache.save()
 
 def break_if_required(file, line_text, do_break):
     if(do_break):
@@ -268,18 +1732,23 @@ def break_if_required(file, line_text, do_break):
         if(len(line_text) > 0):
             file.write("<br><li><b>" + line_text + "</b></li>\n")
 
+def write_error_to_output_html(config, error):
+    with output_sink(config.output, metrics=config.metrics) as sink:
+        write_output_header(config, sink)
+        sink.write(error)
+        write_output_trailer(config, sink)
+
 def write_error_to_output_html_and_close(config, error):
-    write_output_header(config)
-    with open(config.output, 'w') as file:  
-        file.write(error)
-    write_output_trailer(config)
+    write_error_to_output_html(config, error)
+    if(config.journal is not None):
+        config.journal.finish()
     sys.exit()
 
 def validate_username(config):
     validUserName   = False
     while not validUserName:
         thisdata = bgg_getter('user', {'name': config.user_name}, config)
-        root = ElementTree.fromstring(thisdata.content)
+        root = parse_xml(thisdata.content)
         if root.attrib['id']:
             validUserName = True
             logging.info(f'UserName: {config.user_name} is valid')
@@ -288,43 +1757,41 @@ def validate_username(config):
             write_error_to_output_html_and_close(config, f'UserName: {config.user_name} was not valid')
     return config.user_name
 
-def clean_up(config):
+def clean_up(config, args):
     if args.clean_images or args.clean_xml or args.clean_all:
         logging.info('Cleaning...')
         if args.clean_images or args.clean_all:
-            for f in os.listdir(config.images_path):
-                if(os.path.exists(os.path.join(config.images_path, f))):
-                    if(f == 'icon_players.png' or f == 'icon_duration.png'):
-                        continue
+            if(os.path.isdir(config.images_path)):
+                for f in os.listdir(config.images_path):
                     os.remove(os.path.join(config.images_path, f))
         if args.clean_xml or args.clean_all:
             if(os.path.exists(config.collection_xml)):
                 os.remove(config.collection_xml)
-            for f in os.listdir(config.xml_path):
-                if(os.path.join(config.xml_path, f)):
+            if(os.path.isdir(config.xml_path)):
+                for f in os.listdir(config.xml_path):
                     os.remove(os.path.join(config.xml_path, f))
+            open_store(config).clear()
         if args.clean_all:
             with contextlib.suppress(FileNotFoundError):
                 os.remove(config.output)
                 os.remove(config.collection_xml)
         sys.exit()
 
-def write_output_header(config):
-    with open(config.output, 'w') as file:      
-        if(config.web_mode):
-            if(config.card_mode):
-                file.write('<html><head><link href="{{ url_for(\'static\', filename=\'styles/style_card.css\')}}" rel="stylesheet" type="text/css"></head><body>')
-            else:
-                file.write('<html><head><link href="{{ url_for(\'static\', filename=\'styles/style.css\')}}" rel="stylesheet" type="text/css"></head><body>')
+def write_output_header(config, file):
+    if(config.web_mode):
+        if(config.card_mode):
+            file.write('<html><head><link href="{{ url_for(\'static\', filename=\'styles/style_card.css\')}}" rel="stylesheet" type="text/css"></head><body>')
         else:
-            if(config.card_mode):
-                file.write('<html><head><link href="style_card.css" rel="stylesheet" type="text/css"></head><body>')
-            else:
-                file.write('<html><head><link href="style.css" rel="stylesheet" type="text/css"></head><body>')
+            file.write('<html><head><link href="{{ url_for(\'static\', filename=\'styles/style.css\')}}" rel="stylesheet" type="text/css"></head><body>')
+    else:
+        if(config.card_mode):
+            file.write('<html><head><link href="style_card.css" rel="stylesheet" type="text/css"></head><body>')
+        else:
+            file.write('<html><head><link href="style.css" rel="stylesheet" type="text/css"></head><body>')
 
-def write_output_navigation(config, firstchars):
-    with open(config.output, 'a') as file:
-        file.write('''<script>
+#page_links maps each character to the page holding its games, when the output is split into pages.
+def write_output_navigation(config, file, firstchars, page_links=None):
+    file.write('''<script>
 window.onscroll = function() {scrollFunction()};
 
 function scrollFunction() {
@@ -337,151 +1804,259 @@ function scrollFunction() {
 </script>''')
 
 
-        file.write('<div id="navbar" style="top: -50px"><h2 class="Navigation">')
-        for c, present in firstchars.items():
-            if (present == 1):
-                file.write('&nbsp;<a class="Navigation_Link" href="#'+c+'">'+c+'</a>&nbsp; ')
-            else:
-                file.write('&nbsp;'+c+'&nbsp; ')
-        file.write('</div></h2>\n')
-
-def request_collection(config):        
+    file.write('<div id="navbar" style="top: -50px"><h2 class="Navigation">')
+    for c, present in firstchars.items():
+        if (present == 1):
+            page = page_links[c] if page_links else ''
+            file.write('&nbsp;<a class="Navigation_Link" href="'+page+'#'+c+'">'+c+'</a>&nbsp; ')
+        else:
+            file.write('&nbsp;'+c+'&nbsp; ')
+    file.write('</div></h2>\n')
+
+def write_response_to_file(response, path):
+    #Stream the body to a temp file and rename it into place, never holding the whole document.
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                file.write(chunk)
+            sync_file(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    finally:
+        response.close()
+
+def request_collection(config):
     logging.warning('Reading collection from bgg')
+    with config.metrics.stage('collection_fetch'):
+        asyncio.run(fetch_collection(config))
+
+async def fetch_collection(config):
+    #Fetch the user's collection into config.collection_xml. With --incremental, compare it against
+    #the one from the last run.
+    previous = None
+    if(config.incremental and not config.no_cache and os.path.exists(config.collection_xml)):
+        previous = await asyncio.to_thread(lambda: collection_state(iterate_collection(config, config.collection_xml)))
 
-    status = 0
     # Note: Something weird is going on with stats:1. I've seen cases where newly added games don't return
     params = {'username': config.user_name, 'stats': 1}
 
     if config.only_own:
         params['own'] = 1
 
-    collection_response = bgg_getter('collection',params, config)
-    with open(config.collection_xml, 'w', encoding="utf-8") as file:
-        file.write(collection_response.text)
-        return ElementTree.fromstring(collection_response.content)
+    response = await get_client(config).get('collection', params, stream=True)
+    await asyncio.to_thread(write_response_to_file, response, config.collection_xml)
+    journal_collection(config)
+
+    if previous is not None:
+        current = await asyncio.to_thread(lambda: collection_state(iterate_collection(config, config.collection_xml)))
+        report_collection_changes(config, diff_collections(previous, current))
+
+def iterate_collection(config, path):
+    #Yield a collection_information per item, clearing each element once it has been read so
+    #memory stays flat however large the collection is.
+    if xml_backend is lxml_etree:
+        for event, elem in lxml_etree.iterparse(path, events=('end',), tag='item'):
+            yield collection_information(elem, config)
+            elem.clear(keep_tail=True)
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        return
+    root = None
+    for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+        if root is None:
+            root = elem
+        elif event == 'end' and elem.tag == 'item':
+            yield collection_information(elem, config)
+            root.clear()
 
 def read_collection(config):
-    if not (config.no_cache):
-        #Check if collection.xml exists. If it does, read it.
-        if(os.path.exists(config.collection_xml)):
-            logging.warning('Reading ' + config.collection_xml)
-            with open(config.collection_xml, 'r', encoding="utf-8") as file:
-                return ElementTree.fromstring(file.read())
-
-        #Otherwise we request the XML from BGG
-        else:
-          return request_collection(config)  
+    if(config.journal is not None and config.journal.has_collection(config.user_name) and collection_complete(config.collection_xml)):
+        #The interrupted run already fetched it.
+        logging.warning('Resuming with ' + config.collection_xml)
 
-    #Otherwise we request the XML from BGG
-    else:
-        return request_collection(config)  
+    elif(config.incremental and not config.no_cache):
+        #Always refetch, fetch_collection compares against what we had last time.
+        request_collection(config)
 
-def download_and_split_collection_object_info(config, newids):
-    newgamexmls = bgg_getter('thing', {'id': ','.join(newids), 'stats': 1}, config)
-    for item in ElementTree.fromstring(newgamexmls.content):
-        if not (config.no_cache):
-            game_xml_path = os.path.join(config.xml_path, item.attrib['id'] + '.xml')
-            with open(game_xml_path, 'w', encoding='utf-8') as file:
-                logging.info(f'Writing to {game_xml_path}')
-                file.write(ElementTree.tostring(item, encoding='unicode'))
-        else:
-            config.dict_game_info[item.attrib['id']] = item
-        
-
-def find_and_download_new_collection_object_info(config, collection):
-    newids = set()
-    for item in collection:
-        collection_info = collection_information(item, config)
-        if not (os.path.exists(collection_info.game_xml)):
-            newids.add(collection_info.obj_id)
-            logging.debug(f'Adding ID: {collection_info.obj_id} for download')
-        else:
-            logging.debug(f'Skipping ID: {collection_info.obj_id} for download')
-        if len(newids)>100:
-            logging.debug(f'Collected 100 ids - passing for download')
-            download_and_split_collection_object_info(config, newids)
-            newids = set()
-    if newids:
-        logging.debug(f'Downloading remaining new ids')
-        download_and_split_collection_object_info(config, newids)
-
-def gather_index_info(config, gameinfo, item):
-    for count in range(int(gameinfo.minplayers), int(gameinfo.maxplayers)):
-        if(count not in config.dict_player_count):
-            config.dict_player_count[count] = []
-        config.dict_player_count[count].append(gameinfo)
-
-    for x in get_links(item, 'boardgamecategory'):
-        category = x.attrib['value']
-        if(category not in config.dict_category):
-            config.dict_category[category] = []
-        config.dict_category[category].append(gameinfo)
-
-def write_index(config):
+    #Check if collection.xml exists. If it does, read it. Otherwise we request the XML from BGG.
+    elif(config.no_cache or not collection_complete(config.collection_xml)):
+        request_collection(config)
+    else:
+        logging.warning('Reading ' + config.collection_xml)
+
+    return iterate_collection(config, config.collection_xml)
+
+def collection_state(collection_infos):
+    #What we compare between two collection responses: the rating and the status flags of each game.
+    return {info.obj_id: (info.my_rating, info.status) for info in collection_infos}
+
+def diff_collections(old, new):
+    return {
+        'added':   [obj_id for obj_id in new if obj_id not in old],
+        'removed': [obj_id for obj_id in old if obj_id not in new],
+        'changed': [obj_id for obj_id in new if obj_id in old and new[obj_id] != old[obj_id]],
+    }
+
+def report_collection_changes(config, changes):
+    logging.info(f'Collection changes: {len(changes["added"])} added, {len(changes["removed"])} removed, {len(changes["changed"])} changed')
+    for kind, obj_ids in changes.items():
+        if obj_ids:
+            logging.debug(f'{kind}: {", ".join(obj_ids)}')
+    #Fragments of removed games will never be used again.
+    open_store(config).delete_fragments(changes['removed'])
+
+def split_collection_object_info(config, newgamexmls):
+    stored = open_store(config).put_items(newgamexmls.content)
+    logging.info(f'Stored {len(stored)} games in {config.store.path}')
+    return stored
+
+async def download_collection_object_batches(config, planner):
+    client = get_client(config)
+
+    #Each worker keeps taking the next batch the planner hands out, so a refused batch is split
+    #and retried at the new size while the other workers carry on.
+    async def worker():
+        while True:
+            batch = planner.next_batch()
+            if not batch:
+                return
+            config.metrics.count('thing_batches')
+            try:
+                response = await client.get('thing', {'id': ','.join(batch), 'stats': 1})
+            except bgg_error as e:
+                config.metrics.count('thing_batches_refused')
+                planner.refused_batch(batch, e)
+                continue
+            planner.succeeded(batch, split_collection_object_info(config, response))
+
+    await asyncio.gather(*(worker() for _ in range(max(1, config.concurrency))))
+
+def missing_cutoff(config):
+    #Ids BGG had no data for are asked for again once they are as old as --ttl, never with --ttl 0.
+    return time.time() - config.ttl if config.ttl > 0 else 0
+
+def find_and_download_new_collection_object_info(config, collection_infos):
+    #Ids stay in collection order, so the batches, and so the request urls, are the same from run to run.
+    wanted  = dict.fromkeys(info.obj_id for info in collection_infos)
+    missing = open_store(config).missing_ids(wanted, missing_cutoff(config))
+    config.metrics.count('xml_cache_hits', len(wanted) - len(missing))
+    config.metrics.count('xml_cache_misses', len(missing))
+
+    #Batches go out concurrently, paced by the client's rate limit.
+    if missing:
+        logging.debug(f'Downloading {len(missing)} new ids')
+        planner = thing_planner(config, missing)
+        try:
+            with config.metrics.stage('thing_download'):
+                asyncio.run(download_collection_object_batches(config, planner))
+        finally:
+            planner.finish()
+
+def gather_index_info(config, gameinfo):
+    config.index_data.add(gameinfo)
+
+def write_index(config, file):
     if(config.index):
-
-        with open(config.output, 'a') as file:
-            i = 1
-            break_point = 250
-
-            file.write('<p style="page-break-after: always;"></p>\n')
-            file.write("<ul>\n")
-            for count in range(1,10):
-                file.write("<br><li><b>" + str(count) + " player games:" + "</b></li>\n")
-                i += 1
-                break_if_required(file, "",i % break_point == 0)
-                for game in config.dict_player_count[count]:
-                    file.write("<li>" + game.name + "</li>\n")
-                    i += 1
-                    break_if_required(file, str(count) + " player games:", i % break_point == 0)
-            file.write("</ul>\n")
-
-            i = 1
+        with config.metrics.stage('index'):
             break_point = 250
 
-            file.write('<p style="page-break-after: always;"></p>\n')
-            file.write('<ul>\n')
-            for cat in sorted(config.dict_category):
-                file.write("<br><li><b>" + str(cat) + " games:" + "</b></li>\n")
-                i += 1
-                break_if_required(file, "", i % break_point == 0)
-                for game in config.dict_category[cat]:
-                    file.write("<li>" + game.name + "</li>\n")
+            #One page run per facet, each list restarts its own break count.
+            for facet in index_builder.facets:
+                i = 1
+                file.write('<p style="page-break-after: always;"></p>\n')
+                file.write("<ul>\n")
+                for title, games in config.index_data.sections(facet):
+                    file.write("<br><li><b>" + title + "</b></li>\n")
                     i += 1
-                    break_if_required(file, str(cat) + " games:", i % break_point == 0)
-            file.write("</ul>\n")
-
-def write_output_trailer(config):
+                    break_if_required(file, "", i % break_point == 0)
+                    for game in games:
+                        file.write("<li>" + (game.name or "N/A") + "</li>\n")
+                        i += 1
+                        break_if_required(file, title, i % break_point == 0)
+                file.write("</ul>\n")
+
+def write_output_trailer(config, file):
     #Write the html trailer.
-    with open(config.output, 'a') as file:
-            file.write("</body></html>")
-
-
-def iterate_items(config, items, peritemfunc, peritemparam1=None, peritemparam2=None):
-    for item in items:
-        collection_info = collection_information(item, config)
-
-        #Grab only games we own unless own isn't set.
-        if(config.only_own == False or collection_info.own):
-            #Check to see if the XML already exists. If it does, don't re-request it.
-            if(os.path.exists(collection_info.game_xml) and not config.no_cache):
-                with open(collection_info.game_xml, 'r', encoding="utf-8") as file:
-                    thisgameitems = ElementTree.fromstring(file.read())
-            elif not (config.no_cache):
-                    logging.info('game not found')
-                    #Pull the game info XML
-                    game_info_response = bgg_getter('thing', {'id': collection_info.obj_id, 'stats': 1} , config)
-                
-                    #Write out the game info XML.
-                    with open(collection_info.game_xml, 'w', encoding="utf-8") as file:
-                        logging.info("Writing: " + collection_info.game_name + " to " + collection_info.game_xml)
-                        file.write(game_info_response.text)
-                        thisgameitems = ElementTree.fromstring(game_info_response.content)
-            else:
-                thisgameitems = config.dict_game_info[collection_info.obj_id]
-
-            #Now that we have all of the information we need, call the function passed in
-            peritemfunc(collection_info, thisgameitems, config, peritemparam1)
+    with config.metrics.stage('trailer'):
+        file.write("</body></html>")
+
+
+def load_game_item(config, collection_info):
+    store  = open_store(config)
+    fields = store.get(collection_info.obj_id)
+    if fields is None:
+        if store.is_missing(collection_info.obj_id, missing_cutoff(config)):
+            logging.info(f'Skipping {collection_info.game_name} ({collection_info.obj_id}), BGG has no data for it')
+            return None
+        logging.info('game not found: ' + collection_info.obj_id)
+        #Pull the game info XML on its own and store it.
+        try:
+            game_info_response = bgg_getter('thing', {'id': collection_info.obj_id, 'stats': 1} , config)
+            store.put_items(game_info_response.content)
+        except bgg_error as e:
+            logging.warning(f'BGG refused thing {collection_info.obj_id}: {e}')
+        fields = store.get(collection_info.obj_id)
+        if fields is None:
+            logging.warning(f'BGG returned no data for {collection_info.game_name} ({collection_info.obj_id})')
+            store.put_missing([collection_info.obj_id])
+    return fields
+
+def refresh_stale_games(config, records):
+    #Stale entries have already been used for this run. Refetch a capped number of them in a background
+    #thread so the next run sees fresh weights and ratings. The main thread makes no BGG requests after
+    #loading, so the thread can use the shared client and its rate limit on its own.
+    if(config.no_cache or config.ttl <= 0 or config.max_refresh <= 0):
+        return None
+    stale = open_store(config).stale_ids([record.collection_info.obj_id for record in records], time.time() - config.ttl, config.max_refresh)
+    if not stale:
+        return None
+    logging.info(f'Refreshing {len(stale)} stale games in the background')
+    thread = threading.Thread(target=refresh_games, args=(config, stale), name='refresh')
+    thread.start()
+    return thread
+
+def refresh_games(config, obj_ids):
+    #sqlite connections can't be shared between threads, use our own.
+    store = metadata_store(config.metadata_db)
+
+    async def refresh():
+        client = get_client(config)
+        for start in range(0, len(obj_ids), config.refresh_batch):
+            batch    = obj_ids[start:start + config.refresh_batch]
+            response = await client.get('thing', {'id': ','.join(batch), 'stats': 1})
+            store.put_items(response.content)
+            logging.debug(f'Refreshed {len(batch)} games')
+
+    try:
+        asyncio.run(refresh())
+    except Exception:
+        logging.exception('Background refresh failed')
+    finally:
+        store.close()
+
+def load_game_records(config, collection):
+    #Grab only games we own unless own isn't set.
+    collection_infos = []
+    with config.metrics.stage('collection_parse'):
+        for collection_info in collection:
+            if(config.only_own == False or collection_info.own):
+                collection_infos.append(collection_info)
+
+    find_and_download_new_collection_object_info(config, collection_infos)
+
+    #Parse every game once, navigation, rendering and the index all work from these records.
+    records = []
+    with config.metrics.stage('load_records'):
+        for collection_info in collection_infos:
+            fields = load_game_item(config, collection_info)
+            if(fields is not None and fields['type'] == "boardgame"):
+                records.append(game_record(collection_info, fields, config))
+    return records
 
 def parse_name_start(name):
     for article in articles:
@@ -491,200 +2066,605 @@ def parse_name_start(name):
                 return therest.lstrip()
     return name
 
-
-def determine_first_chars(collection_info, thisgameitems, config, firstchars):
-    if(collection_info.game_name is not None):
-        normalized_name = parse_name_start(collection_info.game_name)
-        c = normalized_name[0]
-        if (c.isdigit()):
-            c = '0'
-        firstchars[c] = 1 
-
-
-def write_game_info(collection_info, thisgameitems, config, towrite):
-    if(thisgameitems.attrib['type'] == "boardgame"):
-        game_info = game_information(thisgameitems, config, collection_info)
-        normalized_name = parse_name_start(game_info.name)
-        newfirstchar = normalized_name[0]
+def first_char(name):
+    c = parse_name_start(name)[0]
+    if (c.isdigit()):
+        c = '0'
+    return c
+
+def navigation_chars():
+    #The jump-to list, 1 marks a character that has at least one game.
+    firstchars = {'0': 0}
+    for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
+        firstchars[c] = 0
+    return firstchars
+
+def determine_first_chars(records, firstchars):
+    for record in records:
+        if (record.first_char in firstchars):
+            firstchars[record.first_char] = 1
+
+def fragment_variant(config):
+    #Which template and output settings a cached fragment was rendered with.
+    return f'{load_template(config).path}|{config.card_mode}|{config.no_cache}|{config.paged}|{config.images_path}'
+
+def fragment_key(config, record, anchor):
+    #A hash of everything that goes into a rendered entry.
+    info   = record.collection_info
+    inputs = [load_template(config).digest, fragment_variant(config), anchor,
+              info.my_rating, info.avg_rating, info.my_image, image_location(config, info.obj_id), record.fields]
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+def assign_anchors(records, firstchars):
+    #The first game for each character in the jump-to list gets its anchor.
+    anchors = []
+    for record in records:
         anchor = ""
-        if (newfirstchar.isdigit()):
-            newfirstchar = '0'
-        if (towrite[newfirstchar] == 1):
-            anchor = newfirstchar
-        download_image(config, game_info)
-        template_to_output_entry(config, game_info, anchor)
-        gather_index_info(config, game_info, thisgameitems)
-        towrite[newfirstchar] = 0
-
-######### End Functions #########
-
-#Get arguments.
-args = parse_arguments()
-
-#Create config.
-config = config(args)
-
-#Set loging level.
-logging.basicConfig(level=config.LOGLEVEL)
-
-#Cleanup if args set.
-clean_up(config)
-
-# Create the XML path if it does not exist.
-os.makedirs(config.xml_path, exist_ok=True)
-
-#Validate the username
-config.user_name = validate_username(config)
-
-logging.info('starting')
-
-#Write the html header and link to the approprate CSS file.
-write_output_header(config)
-
-#Read in the collection xml file.
-items = read_collection(config)
-
-#Build the jump-to list
-firstchars = {
-    '0': 0,
-    'A': 0,
-    'B': 0,
-    'C': 0,
-    'D': 0,
-    'E': 0,
-    'F': 0,
-    'G': 0,
-    'H': 0,
-    'I': 0,
-    'J': 0,
-    'K': 0,
-    'L': 0,
-    'M': 0,
-    'N': 0,
-    'O': 0,
-    'P': 0,
-    'Q': 0,
-    'R': 0,
-    'S': 0,
-    'T': 0,
-    'U': 0,
-    'V': 0,
-    'W': 0,
-    'X': 0,
-    'Y': 0,
-    'Z': 0
-}
-
-pp = pprint.PrettyPrinter(indent=4)
-if (config.generate_navigation):
-    for item in items:
-        collection_info = collection_information(item, config)
-
-        #Grab only games we own unless own isn't set.
-        if(config.only_own == False or collection_info.own):
-            #Check to see if the XML already exists. If it does, don't re-request it.
-            if(os.path.exists(collection_info.game_xml) and not config.no_cache):
-                with open(collection_info.game_xml, 'r', encoding="utf-8") as file:
-                    thisgameitems = ElementTree.fromstring(file.read())
-                    for child in thisgameitems:
-                        if (child.tag == "item"):
-                            thisgameitems=child
-                            break
-            elif not (config.no_cache):
-                    logging.info('game not found: ' + collection_info.game_xml)
-                    #Pull the game info XML
-                    game_info_response = bgg_getter('thing', {'id': collection_info.obj_id, 'stats': 1} , config)
-    
-                    #Write out the game info XML.
-                    with open(collection_info.game_xml, 'w', encoding="utf-8") as file:
-                        logging.info("Writing: " + collection_info.game_name + " to " + collection_info.game_xml)
-                        file.write(game_info_response.text)
-                        thisgameitems = ElementTree.fromstring(game_info_response.content)
-                        for child in thisgameitems:
-                            if (child.tag == "item"):
-                                thisgameitems=child
-                                break
-            else:
-                thisgameitems = config.dict_game_info[collection_info.obj_id]
-    
-            #Now that we have all of the information we need, create the HTML page.
-            if(collection_info.game_name is not None):
-                normalized_name = parse_name_start(collection_info.game_name)
-                c = normalized_name[0]
-                if (c.isdigit()):
-                    c = '0'
-                firstchars[c] = 1 
-    write_output_navigation(config, firstchars)
-    
-find_and_download_new_collection_object_info(config, items)
-
-
-for item in items:
-    collection_info = collection_information(item, config)
-
-    #Grab only games we own unless own isn't set.
-    if(config.only_own == False or collection_info.own):
-        #Check to see if the XML already exists. If it does, don't re-request it.
-        if(os.path.exists(collection_info.game_xml) and not config.no_cache):
-            with open(collection_info.game_xml, 'r', encoding="utf-8") as file:
-                thisgameitems = ElementTree.fromstring(file.read())
-                for child in thisgameitems:
-                    if (child.tag == "item"):
-                        thisgameitems=child
-                        break
-        elif not (config.no_cache):
-                logging.info('game not found')
-                #Pull the game info XML
-                game_info_response = bgg_getter('thing', {'id': collection_info.obj_id, 'stats': 1} , config)
-
-                #Write out the game info XML.
-                with open(collection_info.game_xml, 'w', encoding="utf-8") as file:
-                    logging.info("Writing: " + collection_info.game_name + " to " + collection_info.game_xml)
-                    file.write(game_info_response.text)
-                    thisgameitems = ElementTree.fromstring(game_info_response.content)
-                    for child in thisgameitems:
-                        if (child.tag == "item"):
-                            thisgameitems=child
-                            break
-        else:
-            thisgameitems = config.dict_game_info[collection_info.obj_id]
-
-        #Now that we have all of the information we need, create the HTML page.
-        if(thisgameitems.attrib['type'] == "boardgame"):
-            game_info = game_information(thisgameitems, config, collection_info)
-            normalized_name = parse_name_start(game_info.name)
-            newfirstchar = normalized_name[0]
-            anchor = ""
-            if (newfirstchar.isdigit()):
-                newfirstchar = '0'
-            if (firstchars[newfirstchar] == 1):
-                anchor = newfirstchar
-            download_image(config, game_info)
-            template_to_output_entry(config, game_info, anchor)
-            gather_index_info(config, game_info, thisgameitems)
-            firstchars[newfirstchar] = 0
-
-
-#Write the index.
-write_index(config)
+        if (firstchars.get(record.first_char) == 1):
+            anchor = record.first_char
+            firstchars[record.first_char] = 0
+        anchors.append(anchor)
+    return anchors
+
+#Settings for render_shard in a worker process, set once per worker by init_render_worker.
+render_worker_config = None
+
+def init_render_worker(config):
+    global render_worker_config
+    render_worker_config = config
+
+def render_shard(shard):
+    #shard is a list of (collection_info, fields, anchor, local_image, image_size), returns (html, game_info) for each in order.
+    rendered = []
+    for collection_info, fields, anchor, local_image, image_size in shard:
+        game_info = game_information(fields, render_worker_config, collection_info)
+        game_info.local_image = local_image
+        game_info.image_size  = image_size
+        rendered.append((render_entry(render_worker_config, game_info, anchor), game_info))
+    return rendered
+
+def render_pool(config):
+    #Worker processes get a copy of the settings without anything holding a connection or a lock.
+    load_template(config)
+    worker_config        = copy.copy(config)
+    worker_config.client = None
+    worker_config.store  = None
+    worker_config.image_cache = None
+    worker_config.metrics     = None
+    worker_config.cassette    = None
+    worker_config.journal     = None
+    return ProcessPoolExecutor(max_workers=config.jobs, initializer=init_render_worker, initargs=(worker_config,))
+
+def render_parallel(config, records, anchors, indexes, fragments, pool=None):
+    #Split the games into contiguous shards, render them in a process pool and put each fragment
+    #back at its position in collection order. Without a pool from the caller one is made for this call.
+    work        = [(records[i].collection_info, records[i].fields, anchors[i]) + image_location(config, records[i].collection_info.obj_id) for i in indexes]
+    shard_count = config.jobs * 4
+    shard_size  = max(1, -(-len(work) // shard_count))
+    shards      = [work[start:start + shard_size] for start in range(0, len(work), shard_size)]
+
+    position = 0
+    with contextlib.ExitStack() as stack:
+        if pool is None:
+            pool = stack.enter_context(render_pool(config))
+        for shard in pool.map(render_shard, shards):
+            for html, game_info in shard:
+                i = indexes[position]
+                fragments[i] = html
+                records[i]._game_info = game_info
+                position += 1
+
+def game_fragments(config, records, anchors, pool=None):
+    #Yields (record, html) in collection order. pool is an optional render_pool to reuse.
+    fragments = [None] * len(records)
+
+    if(config.incremental):
+        #Reuse the entry from the last run unless one of its inputs changed.
+        variant = fragment_variant(config)
+        keys    = [fragment_key(config, record, anchor) for record, anchor in zip(records, anchors)]
+        for i, record in enumerate(records):
+            fragments[i] = config.store.get_fragment(record.collection_info.obj_id, variant, keys[i])
+
+    todo = [i for i, fragment in enumerate(fragments) if fragment is None]
+    if(config.jobs > 1 and len(todo) > 1):
+        render_parallel(config, records, anchors, todo, fragments, pool)
+
+    rendered = 0
+    pending  = []
+    todo     = set(todo)
+    for i, record in enumerate(records):
+        fragment = fragments[i]
+        if fragment is None:
+            fragment = render_entry(config, record.game_info, anchors[i])
+        if(config.incremental and i in todo):
+            pending.append((record.collection_info.obj_id, variant, keys[i], fragment))
+            rendered += 1
+        fragments[i] = None
+
+        if(config.incremental and (i + 1) % config.checkpoint_every == 0):
+            #Keep what has been rendered so far, rerunning after a crash reuses it.
+            config.store.put_fragments(pending)
+            pending = []
+
+        if(config.index):
+            gather_index_info(config, record.game_info)
+        yield record, fragment
+
+    if(config.incremental):
+        config.store.put_fragments(pending)
+        logging.info(f'Rendered {rendered} of {len(records)} games, reused the rest')
+
+def write_game_records(config, sink, records, firstchars):
+    for record, fragment in game_fragments(config, records, assign_anchors(records, firstchars)):
+        sink.write(fragment)
+
+def page_char(firstchars, record):
+    #Names that don't start with a letter or digit share the 0 page.
+    return record.first_char if record.first_char in firstchars else '0'
+
+def write_paged_output(config, records):
+    #One page per navigation character plus a landing page at config.output linking to them, so the
+    #browser never has to lay out the whole collection at once.
+    firstchars = navigation_chars()
+    with config.metrics.stage('navigation'):
+        determine_first_chars(records, firstchars)
+        firstchars['0'] = 1 if any(page_char(firstchars, record) == '0' for record in records) else firstchars['0']
+    page_paths = {c: suffixed_path(config.output, c) for c in firstchars}
+    page_links = {c: os.path.basename(path) for c, path in page_paths.items()}
+
+    anchors = assign_anchors(records, dict(firstchars))
+    counts  = {}
+    with contextlib.ExitStack() as stack, config.metrics.stage('render'):
+        sinks = {}
+        for record, fragment in game_fragments(config, records, anchors):
+            c = page_char(firstchars, record)
+            if c not in sinks:
+                sinks[c] = stack.enter_context(output_sink(page_paths[c], metrics=config.metrics))
+                write_output_header(config, sinks[c])
+                write_output_navigation(config, sinks[c], firstchars, page_links)
+            sinks[c].write(fragment)
+            counts[c] = counts.get(c, 0) + 1
+        for sink in sinks.values():
+            write_output_trailer(config, sink)
+
+    #Pages from an earlier run for characters that no longer have games.
+    for c, path in page_paths.items():
+        if c not in counts:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+    with output_sink(config.output, metrics=config.metrics) as sink:
+        write_output_header(config, sink)
+        write_output_navigation(config, sink, firstchars, page_links)
+        sink.write('<ul class="Navigation_Pages">\n')
+        for c in firstchars:
+            if c in counts:
+                sink.write(f'<li><a href="{page_links[c]}">{c}</a> ({counts[c]} games)</li>\n')
+        sink.write('</ul>\n')
+        write_index(config, sink)
+        write_output_trailer(config, sink)
+
+def generate_output(config, collection, stream=False):
+    if(stream and config.no_cache and not config.json_mode and not config.paged):
+        write_streamed_output(config, collection)
+        return None
 
-#Write the trailer.
-write_output_trailer(config)
+    #Parse every game in the collection.
+    records = load_game_records(config, collection)
+    refresh_thread = refresh_stale_games(config, records)
 
-endtime = datetime.now()
-totaltime = endtime - starttime
-logging.info(f'command: {sys.argv}')
-logging.info(f'total time: {totaltime}')
+    #Download missing box art first, the page links to images by content hash.
+    with config.metrics.stage('image_download'):
+        download_images(config, records)
 
+    render_output(config, records)
 
+    #Let the background refresh finish storing what it fetched.
+    if refresh_thread is not None:
+        refresh_thread.join()
+    return records
 
+def render_output(config, records):
+    #Everything that depends on the template, from records that are already loaded.
+    if(config.json_mode):
+        write_json_output(config, records)
+    elif(config.paged):
+        write_paged_output(config, records)
+    else:
+        write_single_output(config, records)
+
+def watched_files(config):
+    files = [config.card_template if config.card_mode else config.template, './style.css', './style_card.css']
+    if(config.json_mode):
+        files.append(config.renderer)
+    return files
+
+def file_stamp(path):
+    #None while an editor has the file replaced out from under us.
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
 
+def watch(config, records):
+    #Poll the template and CSS files and rerun only render_output when one changes. Records, box art
+    #and image sizes stay in memory, so no BGG request or XML parse happens again.
+    #The game_info of each record is already built, rendering in this process beats a pool.
+    config.jobs    = 1
+    config.journal = None
+    stamps = {path: file_stamp(path) for path in watched_files(config)}
+    logging.warning(f'Watching {", ".join(stamps)} for changes, press Ctrl+C to stop')
+    try:
+        while True:
+            time.sleep(config.watch_interval)
+            changed = [path for path, stamp in stamps.items() if file_stamp(path) != stamp]
+            if not changed:
+                continue
+            for path in changed:
+                stamps[path] = file_stamp(path)
+            start = time.perf_counter()
+            try:
+                config.compiled_template = None
+                load_template(config)
+                config.index_data = index_builder()
+                render_output(config, records)
+            except Exception:
+                logging.exception('Rewriting the output failed, waiting for the next change')
+                continue
+            logging.warning(f'{", ".join(changed)} changed, rewrote {config.output} in {(time.perf_counter() - start) * 1000:.0f} ms')
+    except KeyboardInterrupt:
+        pass
+
+def stream_game_records(config, collection_infos):
+    #Yields the records a window at a time, in collection order. Each window's thing data is fetched,
+    #handed out and dropped from the in-memory store before the next, so memory is bounded by the
+    #window rather than the collection.
+    store   = open_store(config)
+    planner = thing_planner(config, [])
+    position = 0
+    while position < len(collection_infos):
+        #Enough ids to keep every request slot busy at the planner's current batch size.
+        window   = collection_infos[position:position + planner.size * max(1, config.concurrency)]
+        position += len(window)
+        obj_ids  = [info.obj_id for info in window]
+        planner.pending.extend(store.missing_ids(obj_ids, missing_cutoff(config)))
+        if planner.pending:
+            with config.metrics.stage('thing_download'):
+                asyncio.run(download_collection_object_batches(config, planner))
+            planner.finish()
+
+        records = []
+        for collection_info in window:
+            fields = load_game_item(config, collection_info)
+            if(fields is not None and fields['type'] == "boardgame"):
+                records.append(game_record(collection_info, fields, config))
+        store.delete_things(obj_ids)
+        yield records
+
+def write_streamed_output(config, collection):
+    #--no_cache renders each window of games as soon as its thing data arrives, so memory is bounded by
+    #the window. The jump-to list is written before any game is known, so it is worked out from the
+    #names in the collection. Flushing after each window only empties the buffer into output_sink's
+    #temp file: output.html keeps its old contents until the run completes and the temp file is
+    #renamed over it. A half written page is never visible, at the cost of no partial output.
+    collection_infos = []
+    firstchars = navigation_chars()
+    with config.metrics.stage('collection_parse'):
+        for collection_info in collection:
+            if(config.only_own == False or collection_info.own):
+                collection_infos.append(collection_info)
+                if(collection_info.game_name is not None):
+                    c = first_char(collection_info.game_name)
+                    if (c in firstchars):
+                        firstchars[c] = 1
+    config.metrics.count('xml_cache_misses', len(collection_infos))
+
+    with output_sink(config.output, metrics=config.metrics) as sink:
+        write_output_header(config, sink)
+        if (config.generate_navigation):
+            write_output_navigation(config, sink, firstchars)
+        else:
+            firstchars = navigation_chars()
+
+        count = 0
+        with config.metrics.stage('render'), contextlib.ExitStack() as stack:
+            #One pool for the whole run, not one per window.
+            pool = stack.enter_context(render_pool(config)) if config.jobs > 1 else None
+            for records in stream_game_records(config, collection_infos):
+                for record, fragment in game_fragments(config, records, assign_anchors(records, firstchars), pool):
+                    sink.write(fragment)
+                count += len(records)
+                sink.flush()
+                logging.info(f'Rendered {count} of {len(collection_infos)} games')
+
+        write_index(config, sink)
+        write_output_trailer(config, sink)
+
+def write_single_output(config, records):
+    #Stream everything to a single buffered handle, output.html is only replaced once it is complete.
+    with output_sink(config.output, metrics=config.metrics) as sink:
+        write_single_document(config, sink, records)
+
+def write_single_document(config, sink, records):
+    #Write the html header and link to the approprate CSS file.
+    write_output_header(config, sink)
+
+    #Build the jump-to list
+    firstchars = navigation_chars()
+    if (config.generate_navigation):
+        with config.metrics.stage('navigation'):
+            determine_first_chars(records, firstchars)
+            write_output_navigation(config, sink, firstchars)
+
+    with config.metrics.stage('render'):
+        write_game_records(config, sink, records, firstchars)
+
+    #Write the index.
+    write_index(config, sink)
+
+    #Write the trailer.
+    write_output_trailer(config, sink)
+
+def game_export(config, game_info):
+    #What game_information knows about a game, as plain data. renderer.js formats it the way
+    #template_values does.
+    return {
+        'id':          game_info.obj_id,
+        'name':        game_info.name,
+        'sort':        parse_name_start(game_info.name or ""),
+        'year':        parse_int(game_info.published),
+        'publisher':   game_info.publisher,
+        'designers':   game_info.designers,
+        'artists':     [artist for artist in (game_info.artist1, game_info.artist2) if artist],
+        'categories':  game_info.categories,
+        'mechanics':   game_info.mechanics,
+        'description': game_info.description,
+        'image':       game_info.local_image or game_info.image,
+        'image_size':  game_info.image_size,
+        'players':     [game_info.minplayers, game_info.maxplayers],
+        'time':        [game_info.mintime, game_info.maxtime],
+        'weight':      game_info.avg_weight,
+        'rating':      combined_rating(game_info),
+    }
+
+def write_json_output(config, records):
+    #Compact JSON data for other tools, and a page that builds the entries from it in the browser.
+    games = []
+    with config.metrics.stage('render'):
+        for record in records:
+            games.append(game_export(config, record.game_info))
+            if(config.index):
+                gather_index_info(config, record.game_info)
+        data = json.dumps(games, ensure_ascii=False, separators=(',', ':'))
+
+    with output_sink(os.path.splitext(config.output)[0] + '.json', metrics=config.metrics) as sink:
+        sink.write(data)
+
+    if(config.web_mode):
+        renderer = "{{ url_for('static', filename='scripts/renderer.js') }}"
+    else:
+        renderer = os.path.basename(config.renderer)
+
+    with output_sink(config.output, metrics=config.metrics) as sink:
+        write_output_header(config, sink)
+        sink.write('<div class="Controls">'
+                   '<label>Sort <select id="sort_by"><option value="collection">Collection</option><option value="name">Name</option>'
+                   '<option value="rating">Rating</option><option value="weight">Weight</option><option value="playtime">Play time</option>'
+                   '<option value="year">Year</option></select></label> '
+                   '<label>Filter <input id="filter_by" type="search" placeholder="Name, category or mechanic"></label> '
+                   '<label>Players <input id="players" type="number" min="1" max="20"></label></div>\n')
+        #The settings template_values reads from config, for renderer.js.
+        sink.write(f'<div id="games" data-mechanics-length="{get_mechanics_list_max_length(config)}" data-lazy="{int(config.paged)}"></div>\n')
+        #</ inside a script element would end it early.
+        sink.write('<script type="text/x-template" id="game_template">' + load_template(config).source.replace('</', '<\\/') + '</script>\n')
+        sink.write('<script type="application/json" id="game_data">' + data.replace('</', '<\\/') + '</script>\n')
+        sink.write('<script src="' + renderer + '"></script>\n')
+        write_index(config, sink)
+        write_output_trailer(config, sink)
+
+def suffixed_path(path, suffix):
+    #./output.html -> ./output_<suffix>.html
+    base, ext = os.path.splitext(path)
+    return f'{base}_{suffix}{ext}'
+
+def user_config(base_config, user_name):
+    #Per user copy of the settings. The client, metadata store and compiled template stay shared.
+    user = copy.copy(base_config)
+    user.user_name         = user_name
+    user.output            = suffixed_path(base_config.output, user_name)
+    user.collection_xml    = suffixed_path(base_config.collection_xml, user_name)
+    user.index_data        = index_builder()
+    return user
+
+async def fetch_batch_collections(users):
+    #Validate every user and fetch their collections concurrently under the one shared rate limit.
+    client = get_client(users[0])
+
+    async def fetch(user):
+        root = parse_xml((await client.get('user', {'name': user.user_name})).content)
+        if not root.attrib.get('id'):
+            return False
+        if(user.journal is not None and user.journal.has_collection(user.user_name) and collection_complete(user.collection_xml)):
+            return True
+        if(user.no_cache or user.incremental or not collection_complete(user.collection_xml)):
+            await fetch_collection(user)
+        return True
+
+    return await asyncio.gather(*(fetch(user) for user in users))
+
+def run_batch(base_config, user_names):
+    #Made before the per user copies so they all share them: one rate limit for the whole batch, and
+    #one metadata store, which with --no_cache only lives in memory.
+    get_client(base_config)
+    open_store(base_config)
+    candidates = [user_config(base_config, name) for name in user_names]
+    users = []
+    with base_config.metrics.stage('collection_fetch'):
+        valid_users = asyncio.run(fetch_batch_collections(candidates))
+    for user, valid in zip(candidates, valid_users):
+        if valid:
+            logging.info(f'UserName: {user.user_name} is valid')
+            users.append(user)
+        else:
+            logging.warning(f'UserName: {user.user_name} was not valid')
+            write_error_to_output_html(user, f'UserName: {user.user_name} was not valid')
+
+    #Fetch every game any member has exactly once before rendering anyone.
+    wanted = {}
+    for user in users:
+        for collection_info in iterate_collection(user, user.collection_xml):
+            if(user.only_own == False or collection_info.own):
+                wanted.setdefault(collection_info.obj_id, collection_info)
+    logging.info(f'{len(users)} users, {len(wanted)} distinct games')
+    find_and_download_new_collection_object_info(base_config, list(wanted.values()))
+
+    for user in users:
+        logging.info(f'Writing {user.output}')
+        generate_output(user, iterate_collection(user, user.collection_xml))
+
+def static_path(config, path):
+    #Pages live at /user/<name>, so their relative links to the css, icons and box art arrive under /user/ too.
+    relative = unquote(path).lstrip('/')
+    if relative.startswith('user/'):
+        relative = relative[len('user/'):]
+    full = os.path.realpath(relative)
+    if full in [os.path.realpath(f) for f in ('style.css', 'style_card.css', config.renderer)]:
+        return full
+    for directory in ('icons', config.images_path):
+        directory = os.path.realpath(directory)
+        if os.path.commonpath([full, directory]) == directory and os.path.isfile(full):
+            return full
+    return None
+
+def page_handler(config, cache):
+    class handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+        def send(self, status, body, content_type='text/html; charset=utf-8', headers=()):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url   = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = url.path.strip('/').split('/')
+            if len(parts) == 2 and parts[0] == 'user' and parts[1] and '.' not in parts[1]:
+                card_mode = query.get('cardmode', ['0'])[0] == '1'
+                own       = query.get('own', ['0'])[0] == '1'
+                try:
+                    etag, body = cache.page(unquote(parts[1]), card_mode, own)
+                except unknown_user:
+                    return self.send(404, f'UserName: {unquote(parts[1])} was not valid'.encode('utf-8'))
+                except Exception:
+                    logging.exception(f'Building {self.path} failed')
+                    return self.send(500, b'Building the page failed')
+                headers = (('ETag', etag), ('Cache-Control', 'no-cache'))
+                if self.headers.get('If-None-Match') == etag:
+                    return self.send(304, b'', headers=headers)
+                return self.send(200, body, headers=headers)
+
+            path = static_path(config, url.path)
+            if path is None:
+                return self.send(404, b'Not found')
+            with open(path, 'rb') as file:
+                body = file.read()
+            self.send(200, body, mimetypes.guess_type(path)[0] or 'application/octet-stream', (('Cache-Control', 'max-age=3600'),))
+
+    return handler
+
+def serve(config):
+    #Keep records and templates warm between requests instead of a cold run per page view.
+    cache  = page_cache(config)
+    server = http.server.ThreadingHTTPServer(('', config.serve_port), page_handler(config, cache))
+    server.daemon_threads = True
+
+    def refresh():
+        while True:
+            time.sleep(config.serve_refresh)
+            try:
+                cache.refresh()
+            except Exception:
+                logging.exception('Background collection refresh failed')
+
+    threading.Thread(target=refresh, name='refresh', daemon=True).start()
+    logging.warning(f'Serving on http://localhost:{server.server_address[1]}/user/<name>?cardmode=1&own=1')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main():
+    #Get arguments.
+    args = parse_arguments()
+
+    #Create config.
+    run_config = config(args)
+    if(args.no_lxml):
+        use_etree()
+
+    #Set loging level.
+    logging.basicConfig(level=run_config.LOGLEVEL)
+
+    #Cleanup if args set.
+    clean_up(run_config, args)
+
+    #Open any cassette up front so batch users share it.
+    open_cassette(run_config)
+
+    #Open the metadata cache, importing an old game_xml directory the first time.
+    if not (run_config.no_cache):
+        open_store(run_config).migrate_directory(run_config.xml_path)
+
+    #Compile the output template, reporting any placeholder problems up front.
+    load_template(run_config)
+
+    #Journal every run that caches to disk, so an interrupted one can be resumed.
+    if(not run_config.serve_port and not run_config.no_cache):
+        users = [name.strip() for name in args.batch.split(',') if name.strip()] if args.batch else [run_config.user_name]
+        run_config.journal = run_journal(run_config.journal_path, users, run_config.resume)
+
+    if(run_config.serve_port):
+        serve(run_config)
+    elif(args.batch):
+        run_batch(run_config, [name.strip() for name in args.batch.split(',') if name.strip()])
+    else:
+        #Validate the username
+        with run_config.metrics.stage('validate_username'):
+            run_config.user_name = validate_username(run_config)
 
+        logging.info('starting')
 
+        #Read in the collection xml file and write the output. --watch keeps the records around to rewrite it.
+        records = generate_output(run_config, read_collection(run_config), stream=not run_config.watch)
 
+    endtime = datetime.now()
+    totaltime = endtime - starttime
+    logging.info(f'command: {sys.argv}')
+    logging.info(f'total time: {totaltime}')
 
+    if(run_config.metrics_path):
+        run_config.metrics.write(run_config.metrics_path)
+        logging.info(f'Metrics written to {run_config.metrics_path}')
 
+    if(run_config.cassette is not None):
+        run_config.cassette.close()
 
+    if(run_config.journal is not None):
+        run_config.journal.finish()
 
+    if(run_config.watch):
+        watch(run_config, records)
 
+######### End Functions #########
 
+if __name__ == '__main__':
+    main()
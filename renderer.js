@@ -0,0 +1,118 @@
+// Builds the game entries in the browser from the data written by generate_html.py --json.
+// The data is embedded in the page (so it works from file://) and also written next to it as a .json file.
+
+(function () {
+    var games    = JSON.parse(document.getElementById('game_data').textContent);
+    // The page escapes </ inside the template so it can't end the script element early.
+    var template = document.getElementById('game_template').textContent.replace(/<\\\//g, '</');
+    var list     = document.getElementById('games');
+    var sortBy   = document.getElementById('sort_by');
+    var filterBy = document.getElementById('filter_by');
+    var players  = document.getElementById('players');
+
+    // Settings template_values takes from the config.
+    var mechanicsLength = parseInt(list.getAttribute('data-mechanics-length'), 10);
+    var lazy            = list.getAttribute('data-lazy') === '1';
+
+    // Split the template into literal and placeholder segments once, like compiled_template does.
+    var segments = template.split(/\{\{(\w+)\}\}/);
+
+    function text(value) {
+        return value === null || value === undefined ? '' : String(value);
+    }
+
+    function first(values) {
+        return values.length ? values[0] : null;
+    }
+
+    // Python's round() then str(), so 4 still shows as 4.0.
+    function oneDecimal(value) {
+        var rounded = Math.round(value * 10) / 10;
+        return rounded % 1 === 0 ? rounded.toFixed(1) : String(rounded);
+    }
+
+    function mechanicsList(mechanics) {
+        // As many of the first four as fit in the space the template has for them.
+        var four  = mechanics.slice(0, 4);
+        var three = mechanics.slice(0, 3);
+        var shown = mechanicsLength >= four.join('').length ? four :
+                    mechanicsLength >= three.join('').length ? three : mechanics.slice(0, 2);
+        return shown.join(',');
+    }
+
+    // The same values template_values fills in for the page generate_html.py writes.
+    function templateValues(game) {
+        var attributes = '';
+        if (game.image_size) {
+            attributes += ' width="' + game.image_size[0] + '" height="' + game.image_size[1] + '"';
+        }
+        if (lazy) {
+            attributes += ' loading="lazy" decoding="async"';
+        }
+        var time = game.time[0] !== null && game.time[1] !== null && game.time[0] < game.time[1] ?
+                   game.time[0] + ' - ' + game.time[1] : text(game.time[0]);
+        return {
+            anchor:           '',
+            image:            game.image || '',
+            image_attributes: attributes,
+            BGGLink:          'https://www.boardgamegeek.com/boardgame/' + game.id,
+            GameName:         game.name || 'N/A',
+            Description:      game.description || 'N/A',
+            Published:        game.year === null ? 'N/A' : String(game.year),
+            Publisher:        game.publisher || 'N/A',
+            Designer:         first(game.designers) || 'N/A',
+            Artist:           first(game.artists) || 'N/A',
+            Category:         (game.categories[0] || '') + '<br/>' + (game.categories[1] || ''),
+            Mec:              mechanicsList(game.mechanics),
+            p:                text(game.players[0]) + ' - ' + text(game.players[1]),
+            d:                time,
+            // Weight is doubled to be on the same scale with rating.
+            Weight:           oneDecimal(game.weight * 2),
+            Rating:           oneDecimal(game.rating)
+        };
+    }
+
+    function render(game) {
+        var values = templateValues(game);
+        var parts  = segments.slice();
+        for (var i = 1; i < parts.length; i += 2) {
+            var value = values[parts[i]];
+            parts[i] = value === undefined ? '{{' + parts[i] + '}}' : value;
+        }
+        return parts.join('');
+    }
+
+    var sorts = {
+        // Array.sort is stable, so this keeps the collection order.
+        collection: function () { return 0; },
+        name:     function (a, b) { return a.sort.localeCompare(b.sort); },
+        rating:   function (a, b) { return b.rating - a.rating; },
+        weight:   function (a, b) { return b.weight - a.weight; },
+        playtime: function (a, b) { return (a.time[0] || 0) - (b.time[0] || 0); },
+        year:     function (a, b) { return (b.year || 0) - (a.year || 0); }
+    };
+
+    function matches(game, text, count) {
+        if (count && !(game.players[0] <= count && count <= game.players[1])) {
+            return false;
+        }
+        if (!text) {
+            return true;
+        }
+        var haystack = [game.name].concat(game.categories, game.mechanics).join('\n').toLowerCase();
+        return haystack.indexOf(text) !== -1;
+    }
+
+    function update() {
+        var text  = filterBy.value.trim().toLowerCase();
+        var count = parseInt(players.value, 10) || 0;
+        var shown = games.filter(function (game) { return matches(game, text, count); });
+        shown.sort(sorts[sortBy.value] || sorts.collection);
+        list.innerHTML = shown.map(render).join('');
+    }
+
+    sortBy.addEventListener('change', update);
+    filterBy.addEventListener('input', update);
+    players.addEventListener('input', update);
+    update();
+})();